@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Benchmark suite for genpack itself (see docs/benchmark.md).
+#
+# Builds a synthetic artifact with a stand-in genpack-helper (fake-genpack-helper) and fake
+# stage3/portage/overlay tarballs, runs a fixed sequence of scenarios against it, appends the
+# timings to a results file and flags scenarios that got slower than in previous runs.
+import os,sys,io,json,time,argparse,subprocess,tempfile,shutil,tarfile,hashlib,random,statistics,logging,threading,functools,http.server,runpy
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GENPACK = os.path.join(os.path.dirname(BENCH_DIR), "src", "genpack.py")
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, "results.jsonl")
+COMPRESSIONS = ["gzip", "xz", "lzo", "zstd", "none"]
+# compressors fake-genpack-helper stands in for mksquashfs with
+COMPRESSION_TOOLS = {"gzip": "gzip", "xz": "xz", "lzo": "lzop", "zstd": "zstd", "none": "cat"}
+# directory and file name components of the Gentoo stage3 of each architecture
+GENTOO_ARCH = {"x86_64": ("amd64", "amd64"), "aarch64": ("arm64", "arm64"), "i686": ("x86", "i686"), "riscv64": ("riscv", "rv64_lp64d")}
+STAGE3_BUILD = "20260101T000000Z"
+
+def tar_add(tar, path, content=b"", mode=0o644):
+    info = tarfile.TarInfo(path)
+    if content is None:
+        info.type, info.mode = tarfile.DIRTYPE, 0o755
+        tar.addfile(info)
+        return
+    #else
+    if isinstance(content, str): content = content.encode()
+    info.size, info.mode = len(content), mode
+    tar.addfile(info, io.BytesIO(content))
+
+def tarball_paths(project_dir, mirror_dir, arch):
+    """Where the fake stage3, portage and overlay tarballs go: into a local mirror laid out like a
+    Gentoo one (plus the overlay), or with mirror_dir None, into work/ as if downloaded before."""
+    if mirror_dir is None:
+        os.makedirs(os.path.join(project_dir, "work", arch))
+        return (os.path.join(project_dir, "work", arch, "stage3.tar.xz"), os.path.join(project_dir, "work", "portage.tar.xz"),
+                os.path.join(project_dir, "work", "genpack-overlay.tar.gz"))
+    #else
+    gentoo_arch, stage3_arch = GENTOO_ARCH[arch]
+    autobuilds = os.path.join(mirror_dir, "releases", gentoo_arch, "autobuilds")
+    stage3 = f"{STAGE3_BUILD}/stage3-{stage3_arch}-systemd-{STAGE3_BUILD}.tar.xz"
+    os.makedirs(os.path.join(autobuilds, STAGE3_BUILD))
+    os.makedirs(os.path.join(mirror_dir, "snapshots"))
+    with open(os.path.join(autobuilds, f"latest-stage3-{stage3_arch}-systemd.txt"), "w") as f:
+        f.write(f"-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n{stage3} 0\n-----BEGIN PGP SIGNATURE-----\n")
+    return (os.path.join(autobuilds, stage3), os.path.join(mirror_dir, "snapshots", "portage-latest.tar.xz"),
+            os.path.join(mirror_dir, "genpack-overlay.tar.gz"))
+
+def make_tarballs(paths, packages, payload_mib, seed):
+    """Fake stage3, portage and overlay tarballs at paths (see tarball_paths())."""
+    stage3_path, portage_path, overlay_path = paths
+    rng = random.Random(seed)
+    with tarfile.open(stage3_path, "w:xz", preset=0) as tar:
+        tar_add(tar, "etc/passwd", "root:x:0:0:root:/root:/bin/sh\nportage:x:250:250:portage:/var/tmp/portage:/bin/false\n")
+        tar_add(tar, "etc/group", "root:x:0:\nportage:x:250:\n")
+        tar_add(tar, "etc/portage/make.conf", 'FEATURES="buildpkg"\n')
+        tar_add(tar, "etc/genpack-bench/costs", "".join(f"{key} {cost}\n" for key, cost in packages.items()))
+        tar_add(tar, "var/lib/portage/world", "")
+        tar_add(tar, "var/cache/distfiles", None)
+        tar_add(tar, "var/db/pkg/sys-apps/baselayout-1.0/BUILD_ID", "1\n")
+        # what genpack-copyup brings into the upper layer and pack compresses: half text, half random
+        words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(2000)]
+        for i in range(payload_mib):
+            if i % 2 == 0:
+                content = b" ".join(rng.choice(words) for _ in range(200000))[:1024 * 1024]
+            else:
+                content = rng.randbytes(1024 * 1024)
+            tar_add(tar, f"opt/genpack-bench-payload/{i:04d}.dat", content)
+    with tarfile.open(portage_path, "w:xz", preset=0) as tar:
+        tar_add(tar, "portage/metadata/timestamp", "bench\n")
+    with tarfile.open(overlay_path, "w:gz") as tar:
+        tar_add(tar, "genpack-overlay/profiles/repo_name", "genpack-overlay\n")
+
+def make_project(project_dir, packages):
+    os.makedirs(os.path.join(project_dir, "files", "etc"))
+    with open(os.path.join(project_dir, "files", "etc", "bench.conf"), "w") as f:
+        f.write("iteration=0\n")
+    keys = sorted(packages)
+    genpack_json = {
+        "name": "bench",
+        "lower-layer-capacity": 1,
+        "upper-layer-capacity": 1,
+        "packages": [k for k in keys if not k.startswith("dev-util/")],
+        "buildtime_packages": [k for k in keys if k.startswith("dev-util/")],
+        "use": {keys[0]: "bench"},
+        "services": ["bench.service"],
+    }
+    write_genpack_json(project_dir, genpack_json)
+    return genpack_json
+
+def write_genpack_json(project_dir, genpack_json):
+    with open(os.path.join(project_dir, "genpack.json5"), "w") as f:
+        json.dump(genpack_json, f, indent=2)
+
+def synthetic_packages(count, build_time, seed):
+    """cat/pn -> seconds to build it from source; a few heavy ones like a real artifact has."""
+    rng = random.Random(seed)
+    packages = {f"app-misc/bench-pkg{i:03d}": round(build_time * rng.uniform(0.5, 1.5), 3) for i in range(count)}
+    packages.update({f"dev-util/bench-tool{i}": build_time for i in range(2)})
+    packages["sys-kernel/gentoo-kernel"] = build_time * 10
+    return packages
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve_mirror(mirror_dir):
+    """Serve mirror_dir over HTTP on a free local port in the background; returns its URL."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietRequestHandler, directory=mirror_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+class Bench:
+    def __init__(self, args, scratch, mirror_url):
+        self.args = args
+        # genpack versions without --mirror can only be run offline
+        self.genpack_opts = ["--offline"] if mirror_url is None else ["--mirror", mirror_url, "--overlay-url", mirror_url + "genpack-overlay.tar.gz"]
+        self.project_dir = os.path.join(scratch, "project")
+        bin_dir = os.path.join(scratch, "bin")
+        tools_dir = os.path.join(scratch, "tools")
+        os.makedirs(bin_dir)
+        os.makedirs(tools_dir)
+        os.makedirs(os.path.join(scratch, "home"))
+        helper = os.path.join(tools_dir, "fake-genpack-helper")
+        shutil.copy(os.path.join(BENCH_DIR, "fake-genpack-helper"), helper)
+        os.symlink(helper, os.path.join(bin_dir, "genpack-helper"))
+        # the same script simulates the tools inside the container, where only tools_dir is visible
+        for name in subprocess.run([sys.executable, "-c", "import runpy; print(' '.join(runpy.run_path(" + repr(helper) + ")['TOOL_NAMES']))"],
+                                   check=True, stdout=subprocess.PIPE, text=True).stdout.split():
+            os.symlink("fake-genpack-helper", os.path.join(tools_dir, name))
+        self.env = dict(os.environ, HOME=os.path.join(scratch, "home"), PATH=bin_dir + os.pathsep + os.environ["PATH"],
+                        GENPACK_BENCH_TOOLS=tools_dir, GENPACK_BENCH_TIME_SCALE=str(args.time_scale))
+        self.log = open(os.path.join(scratch, "genpack.log"), "w")
+
+    def genpack(self, *argv):
+        """Run genpack in the project and return (wall seconds, build report or None)."""
+        command = [sys.executable, self.args.genpack] + self.genpack_opts + list(argv)
+        self.log.write(f"$ {' '.join(command)}\n")
+        self.log.flush()
+        start = time.monotonic()
+        subprocess.run(command, cwd=self.project_dir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT, check=True)
+        wall = time.monotonic() - start
+        report_path = os.path.join(self.project_dir, "work", self.args.arch, "build-report.json")
+        report = json.load(open(report_path)) if os.path.isfile(report_path) else None
+        return wall, report
+
+def scenarios(bench, genpack_json, compressions):
+    """(name, function) in the order they run; each starts from the state the previous one left."""
+    project_dir = bench.project_dir
+    def touch_files():
+        path = os.path.join(project_dir, "files", "etc", "bench.conf")
+        with open(path, "a") as f:
+            f.write("iteration+=1\n")
+    def change_use():
+        keys = sorted(k for k in genpack_json["packages"])
+        genpack_json["use"] = {keys[0]: "bench -extra"}
+        write_genpack_json(project_dir, genpack_json)
+    result = [
+        ("cold-build", lambda: bench.genpack("build")),
+        ("noop-build", lambda: bench.genpack("build")),
+    ]
+    # before the incremental upper builds, whose snapshots the stand-in helper keeps no image contents of
+    for compression in compressions:
+        # "zstd:19" packs with --compression-level 19
+        algorithm, _, level = compression.partition(":")
+        argv = ["--compression", algorithm] + (["--compression-level", level] if level else [])
+        result.append((f"pack-{compression.replace(':', '-')}", lambda argv=argv: bench.genpack(*argv, "pack")))
+    result.append(("upper-iteration", lambda: (touch_files(), bench.genpack("--incremental", "upper"))[1]))
+    result.append(("upper-iteration-noop", lambda: bench.genpack("--incremental", "upper")))
+    result.append(("lower-config-change", lambda: (change_use(), bench.genpack("build"))[1]))
+    return result
+
+def phase_walls(report):
+    return {} if report is None else {phase["name"]: round(phase["wall"], 3) for phase in report["phases"]}
+
+def image_size(report):
+    """Size of the image the pack phase of the build report created, or None."""
+    for phase in [] if report is None else report["phases"]:
+        for step in phase.get("steps", []):
+            if "output_size" in step: return step["output_size"]
+    return None
+
+def load_results(path):
+    if not os.path.isfile(path): return []
+    #else
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+WORKLOAD_KEYS = ["host", "scenario", "packages", "payload", "time_scale", "offline"]
+
+def baseline(results, record, runs):
+    """Median wall time of the last runs successful results of the same scenario and workload on
+    the same host, or None."""
+    walls = [r["wall"] for r in results
+             if r["status"] == "ok" and all(r.get(k) == record[k] for k in WORKLOAD_KEYS)][-runs:]
+    return statistics.median(walls) if len(walls) > 0 else None
+
+def genpack_label(path):
+    """git describe of the tree genpack is run from, or a hash of the script for an installed one."""
+    describe = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(path),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if describe.returncode == 0: return describe.stdout.strip()
+    #else
+    return "sha256:" + hashlib.sha256(open(path, "rb").read()).hexdigest()[:12]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark genpack with a stand-in genpack-helper and synthetic artifact")
+    parser.add_argument("--genpack", default=DEFAULT_GENPACK, help="genpack script to benchmark (default: this tree's src/genpack.py)")
+    parser.add_argument("--label", default=None, help="Label recorded with the results (default: git describe of the genpack tree)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="JSON lines file the timings are appended to")
+    parser.add_argument("--scenario", action="append", default=None, help="Run only this scenario (repeatable); the earlier ones still run to set up state but are not recorded")
+    parser.add_argument("--compressions", default=",".join(COMPRESSIONS), help="Comma-separated compressions for the pack-* scenarios, optionally with a level (e.g. zstd:19)")
+    parser.add_argument("--packages", type=int, default=30, help="Number of synthetic packages")
+    parser.add_argument("--build-time", type=float, default=0.2, help="Average seconds to build a synthetic package from source")
+    parser.add_argument("--payload", type=int, default=32, help="MiB of files in the synthetic image")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Factor applied to all simulated delays")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown against the baseline flagged as a regression (default: 0.2)")
+    parser.add_argument("--min-delta", type=float, default=0.5, help="Slowdowns smaller than this many seconds are never flagged")
+    parser.add_argument("--baseline-runs", type=int, default=5, help="Number of previous results the baseline is the median of")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic artifact")
+    parser.add_argument("--offline", action="store_true", help="Seed work/ with the tarballs and run genpack --offline instead of fetching from a local mirror (for genpack versions without --mirror)")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args.genpack = os.path.abspath(args.genpack)
+    args.arch = os.uname().machine
+
+    # the compressors run inside the stand-in helper's chroot, which sees only part of the host
+    chroot_path = runpy.run_path(os.path.join(BENCH_DIR, "fake-genpack-helper"))["CHROOT_PATH"]
+    compressions = []
+    for compression in args.compressions.split(","):
+        algorithm = compression.partition(":")[0]
+        if shutil.which("mksquashfs", path=chroot_path) or shutil.which(COMPRESSION_TOOLS.get(algorithm, algorithm), path=chroot_path):
+            compressions.append(compression)
+        else:
+            logging.warning(f"Skipping pack-{compression}: neither mksquashfs nor {COMPRESSION_TOOLS.get(algorithm)} is in {chroot_path}")
+
+    scratch = tempfile.mkdtemp(prefix="genpack-bench-")
+    results = load_results(args.results)
+    host = os.uname().nodename
+    label = args.label or genpack_label(args.genpack)
+    regressions = []
+    try:
+        packages = synthetic_packages(args.packages, args.build_time, args.seed)
+        mirror_dir = None if args.offline else os.path.join(scratch, "mirror")
+        bench = Bench(args, scratch, None if mirror_dir is None else serve_mirror(mirror_dir))
+        genpack_json = make_project(bench.project_dir, packages)
+        make_tarballs(tarball_paths(bench.project_dir, mirror_dir, args.arch), packages, args.payload, args.seed)
+        logging.info(f"Benchmarking {args.genpack} ({label}) in {scratch}")
+        logging.info(f"{'Scenario':<24} {'Wall':>9} {'Baseline':>9} {'Change':>8}  Phases")
+        with open(args.results, "a") as results_file:
+            for name, run in scenarios(bench, genpack_json, compressions):
+                record = {"time": time.time(), "host": host, "cpus": os.cpu_count(), "genpack": label, "scenario": name,
+                          "packages": args.packages, "payload": args.payload, "time_scale": args.time_scale, "offline": args.offline}
+                try:
+                    wall, report = run()
+                    record.update(status="ok", wall=round(wall, 3), phases=phase_walls(report))
+                    if image_size(report) is not None: record["image_size"] = image_size(report)
+                except subprocess.CalledProcessError as e:
+                    record.update(status="failed", wall=None, phases={})
+                    logging.error(f"{name} failed ({e}), see {bench.log.name}")
+                selected = args.scenario is None or name in args.scenario
+                if not selected:
+                    # the later scenarios start from the state this one leaves; without it, they measure nothing
+                    if record["status"] != "ok": break
+                    #else
+                    continue
+                #else
+                base = baseline(results, record, args.baseline_runs)
+                change = ""
+                if record["status"] == "ok" and base is not None:
+                    change = f"{(record['wall'] - base) / base * 100:+.1f}%"
+                    if record["wall"] > base * (1 + args.threshold) and record["wall"] - base > args.min_delta:
+                        regressions.append(name)
+                        change += " REGRESSION"
+                wall = f"{record['wall']:.2f}s" if record["wall"] is not None else "failed"
+                phases = " ".join(f"{k}={v:.2f}s" for k, v in record["phases"].items())
+                if "image_size" in record: phases += f" image={record['image_size'] / 1024 / 1024:.1f}MiB"
+                logging.info(f"{name:<24} {wall:>9} {'' if base is None else f'{base:.2f}s':>9} {change:>8}  {phases}")
+                results_file.write(json.dumps(record) + "\n")
+                if record["status"] != "ok": break
+    finally:
+        if args.keep:
+            logging.info(f"Scratch directory kept at {scratch}")
+        else:
+            subprocess.run(["rm", "-rf", scratch])
+    if len(regressions) > 0:
+        logging.error(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@
 #include <cstring>
 #include <csignal>
 #include <functional>
+#include <algorithm>
+#include <cctype>
 
 #include <libmount/libmount.h>
 #include <blkid/blkid.h>
@@ -290,8 +292,11 @@ struct NspawnOptions {
     std::optional<std::filesystem::path> genpack_overlay_dir;
     std::optional<std::filesystem::path> binpkgs_dir;
     std::optional<std::filesystem::path> download_dir;
+    std::optional<std::filesystem::path> ccache_dir;
+    std::optional<std::filesystem::path> distfiles_dir;
     std::optional<std::pair<std::filesystem::path,std::filesystem::path>> overlay_image;
     std::optional<std::filesystem::path> extra_image;
+    std::optional<std::string> portage_tmpfs; // size of a tmpfs to mount at /var/tmp/portage
 };
 
 static uint64_t phys_bytes(void){
@@ -340,11 +345,35 @@ int nspawn(const std::filesystem::path& lower_img,
         if (original_uid != 0) bind += ":rootidmap";
         nspawn_cmdline.push_back(bind);
     }
+    // portage compiles and fetches as the portage user; genpack chowns the subdirectories it uses
+    // to portage from inside the container, which works on the id-mapped mounts as well
+    if (options.ccache_dir) {
+        must_be_owned_by_original_user(*options.ccache_dir);
+        std::string bind = "--bind=" + escape_colon(*options.ccache_dir) + ":/var/cache/ccache";
+        if (original_uid != 0) bind += ":rootidmap";
+        nspawn_cmdline.push_back(bind);
+    }
+    if (options.distfiles_dir) {
+        must_be_owned_by_original_user(*options.distfiles_dir);
+        std::string bind = "--bind=" + escape_colon(*options.distfiles_dir) + ":/var/cache/genpack-distfiles";
+        if (original_uid != 0) bind += ":rootidmap";
+        nspawn_cmdline.push_back(bind);
+    }
     if (options.genpack_overlay_dir) {
         must_be_owned_by_original_user(*options.genpack_overlay_dir);
         std::string bind = "--bind-ro=" + escape_colon(*options.genpack_overlay_dir) + ":/var/db/repos/genpack-overlay";
         nspawn_cmdline.push_back(bind);
     }
+    if (options.portage_tmpfs) {
+        // size as accepted by tmpfs: a number optionally followed by k, m, g or %
+        const auto& size = *options.portage_tmpfs;
+        auto digits_end = std::find_if_not(size.begin(), size.end(), [](char c) { return std::isdigit((unsigned char)c); });
+        if (digits_end == size.begin() || (digits_end != size.end() && (digits_end + 1 != size.end() || std::string("kKmMgG%").find(*digits_end) == std::string::npos))) {
+            throw std::invalid_argument("Invalid tmpfs size: " + size);
+        }
+        // owned by portage (uid/gid 250 on Gentoo) like the on-disk /var/tmp/portage
+        nspawn_cmdline.push_back("--tmpfs=/var/tmp/portage:mode=0775,uid=250,gid=250,size=" + size);
+    }
     for (const auto& [key, value] : options.env_vars) {
         nspawn_cmdline.push_back("--setenv=" + key + "=" + value);
     }
@@ -558,6 +587,12 @@ int main(int argc, const char* argv[])
                 argparser.add_argument("--download-dir", "-D", "Directory for downloading files in the lower image.")
                     .nargs(1)
                     .help("Directory for downloading files in the lower image.");
+                argparser.add_argument("--ccache-dir", "-C", "Directory for the compiler cache.")
+                    .nargs(1)
+                    .help("Directory bound to /var/cache/ccache in the lower image.");
+                argparser.add_argument("--distfiles-dir", "-F", "Directory for shared distfiles.")
+                    .nargs(1)
+                    .help("Directory bound to /var/cache/genpack-distfiles in the lower image.");
                 argparser.add_argument("--genpack-overlay-dir", "-O", "Override the genpack overlay directory.")
                     .nargs(1)
                     .help("Override the genpack overlay directory in the lower image.");
@@ -567,6 +602,9 @@ int main(int argc, const char* argv[])
                 argparser.add_argument("--extra-image", "-X", "Path to an extra image to bind mount.")
                     .nargs(1)
                     .help("Path to an extra image to bind mount in the lower image.");
+                argparser.add_argument("--portage-tmpfs", "-T", "Size of a tmpfs to mount at /var/tmp/portage.")
+                    .nargs(1)
+                    .help("Mount a tmpfs of the given size (e.g. 16G) at /var/tmp/portage so that builds happen in memory.");
                 argparser.add_argument("command", "The command to run in the lower image using systemd-nspawn.")
                     .remaining()
                     .help("Command to run in the lower image using systemd-nspawn.");
@@ -605,8 +643,11 @@ int main(int argc, const char* argv[])
                     .genpack_overlay_dir = argparser.present<std::string>("--genpack-overlay-dir"),
                     .binpkgs_dir = argparser.present<std::string>("--binpkgs-dir"),
                     .download_dir = argparser.present<std::string>("--download-dir"),
+                    .ccache_dir = argparser.present<std::string>("--ccache-dir"),
+                    .distfiles_dir = argparser.present<std::string>("--distfiles-dir"),
                     .overlay_image = overlay_image,
-                    .extra_image = argparser.present<std::string>("--extra-image")
+                    .extra_image = argparser.present<std::string>("--extra-image"),
+                    .portage_tmpfs = argparser.present<std::string>("--portage-tmpfs")
                 });
             }
         }},
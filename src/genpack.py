@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import os,logging,io,tarfile,subprocess,re,json,argparse,json,time,fcntl,struct,errno
+import os,sys,logging,io,tarfile,subprocess,re,json,argparse,json,time,fcntl,struct,errno,hashlib,select,shlex,shutil,tempfile
+import concurrent.futures,contextlib,urllib.parse,resource,http.server,socket
 from pathlib import Path
 from typing import Optional, Literal
 
@@ -12,6 +13,21 @@ import requests # dev-python/requests
 DEFAULT_LOWER_SIZE_IN_GIB = 128  # Default max size of lower image in GiB
 DEFAULT_UPPER_SIZE_IN_GIB = 20  # Default max size of upper image in GiB
 
+HTTP_TIMEOUT = (10, 60)  # (connect, read) timeout in seconds for mirror requests
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # write downloads in 1 MiB chunks
+DEFAULT_TARBALL_CACHE_SIZE_IN_GIB = 16  # Default size budget of the shared tarball cache in GiB
+PREFETCH_JOBS = 4  # concurrent downloads of the distfiles prefetch before compiling
+SHARED_DISTDIR = "/var/cache/genpack-distfiles/files"  # DISTDIR inside the bound shared distfiles dir
+DEFAULT_CCACHE_SIZE = "20G"  # Default size limit of the per-arch compiler cache
+CCACHE_DIR = "/var/cache/ccache/cache"  # CCACHE_DIR inside the bound per-arch ccache dir
+DEFAULT_BINPKG_CACHE_SIZE_IN_GIB = 64  # Default size budget of the shared binpkg caches (all architectures) in GiB
+MEMORY_PER_MAKE_JOB_IN_GIB = 2  # memory a compiler process may need, bounds the total number of make jobs
+STAGE3_POINTER_TTL = 3600  # seconds to trust a previously resolved latest-stage3 pointer
+DEFAULT_OVERLAY_URL = "https://github.com/wbrxcorp/genpack-overlay/archive/refs/heads/main.tar.gz"
+DEFAULT_MIRROR_PORT = 8080  # port of 'genpack mirror serve'
+COMPRESSIONS = ["gzip", "xz", "lzo", "zstd", "none"]  # SquashFS compressors genpack-create-image is asked for
+COMPRESSION_LEVELS = {"gzip": (1, 9), "lzo": (1, 9), "zstd": (1, 22)}  # compressors taking a level, and its range
+
 # Map terminal types that nspawn containers don't have terminfo for to compatible alternatives.
 TERM_COMPAT_MAP = {
     "xterm-ghostty": "xterm-256color",
@@ -38,17 +54,29 @@ work_dir = os.path.join(work_root, arch)
 cache_root = os.path.join(os.path.expanduser("~"), ".cache/genpack")
 cache_arch_dir = os.path.join(cache_root, arch)
 binpkgs_dir = os.path.join(cache_arch_dir, "binpkgs")
+ccache_dir = os.path.join(cache_arch_dir, "ccache")
 download_dir = os.path.join(cache_root, "download")
+distfiles_dir = os.path.join(cache_root, "distfiles")  # source tarballs are not architecture specific
 cache_overlay_dir = os.path.join(cache_root, "overlay")
+tarball_cache_dir = os.path.join(cache_root, "tarballs")  # shared by all artifacts and architectures
+image_template_dir = os.path.join(cache_root, "templates")  # pre-formatted empty filesystem images
 
-base_url = "https://distfiles.gentoo.org/"
+base_url = "https://distfiles.gentoo.org/"  # Gentoo mirror for stage3 and portage tarballs, see --mirror
+overlay_url = DEFAULT_OVERLAY_URL
+gentoo_mirrors = None  # GENTOO_MIRRORS for portage when a Gentoo mirror is configured
 user_agent = "genpack/0.1"
 overlay_override = None
 independent_binpkgs = False
+independent_distfiles = False
 deep_depclean = False
 parallel = False
+offline = False
+build_session = True  # run each build phase in one long-lived container
+ccache_size = None  # size limit of the compiler cache (e.g. "20G"), None when ccache is not used
+portage_tmpfs = None  # size of the tmpfs mounted at /var/tmp/portage for lower emerges (e.g. "16G")
+binhost = None  # base URL (http(s):// or file://) of a remote binary package host
+binhost_push = False  # upload the binpkgs built by lower to the binhost
 genpack_json = None
-genpack_json_time = None
 
 container_name = "genpack-%d" % os.getpid()
 
@@ -61,6 +89,21 @@ class Variant:
         # completed a full build; gates the automatic circular-dep breaker
         self.lower_fresh = os.path.join(work_dir, "lower.fresh") if self.name is None else os.path.join(work_dir, "lower-%s.fresh" % self.name)
         self.upper_image = os.path.join(work_dir, "upper.img") if self.name is None else os.path.join(work_dir, "upper-%s.img" % self.name)
+        # hashes of the lower inputs and copy of the world file, both recorded when lower.done is written
+        self.lower_inputs = os.path.join(work_dir, "lower.inputs.json") if self.name is None else os.path.join(work_dir, "lower-%s.inputs.json" % self.name)
+        self.lower_world = os.path.join(work_dir, "lower.world") if self.name is None else os.path.join(work_dir, "lower-%s.world" % self.name)
+        # lower.done stamp of the base lower image a variant's lower image was branched from (share_lower)
+        self.lower_base = os.path.join(work_dir, "lower.base") if self.name is None else os.path.join(work_dir, "lower-%s.base" % self.name)
+        # installed packages (CPV and BUILD_ID) of the lower image, for binpkg usage tracking and emerge reports
+        self.lower_packages = os.path.join(work_dir, "lower.packages") if self.name is None else os.path.join(work_dir, "lower-%s.packages" % self.name)
+        # timings and resource usage of the last build (see BuildReport)
+        self.build_report = os.path.join(work_dir, "build-report.json") if self.name is None else os.path.join(work_dir, "build-report-%s.json" % self.name)
+        # packages merged by the last lower build, with build times and why they were built from source
+        self.emerge_report = os.path.join(work_dir, "emerge-report.json") if self.name is None else os.path.join(work_dir, "emerge-report-%s.json" % self.name)
+        # compression settings, image size and time of every pack, one JSON object per line
+        self.pack_history = os.path.join(work_dir, "pack-history.jsonl") if self.name is None else os.path.join(work_dir, "pack-history-%s.jsonl" % self.name)
+        # snapshots of the upper image taken after each step by incremental upper builds
+        self.upper_snapshot_dir = os.path.join(work_dir, "upper.snapshots") if self.name is None else os.path.join(work_dir, "upper-%s.snapshots" % self.name)
 
 LockMode = Literal["shared", "exclusive"]
 
@@ -91,31 +134,56 @@ class DirectoryLock:
         # 読み取り/書き込みどちらでも開けるように 'a+' を利用（ファイルを必ず作成）
         fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o644)
         self._fd = fd
+        try:
+            self._flock(fcntl.LOCK_EX if self.mode == "exclusive" else fcntl.LOCK_SH)
+        except BaseException:
+            os.close(fd)
+            self._fd = None
+            raise
+        self._locked = True
 
-        flag = fcntl.LOCK_EX if self.mode == "exclusive" else fcntl.LOCK_SH
+    def convert(self, mode: LockMode) -> None:
+        """保持中のロックを共有/排他に切り替える（アトミックではない: 一旦解放されてから取り直される）。
+        切り替えに失敗した場合（タイムアウト・割り込み）は元のモードで取り直してから例外を送出する。"""
+        previous = self.mode
+        self.mode = mode
+        try:
+            self._flock(fcntl.LOCK_EX if mode == "exclusive" else fcntl.LOCK_SH)
+        except BaseException:
+            self.mode = previous
+            fcntl.flock(self._fd, fcntl.LOCK_EX if previous == "exclusive" else fcntl.LOCK_SH)
+            raise
 
-        if self.timeout is None:
-            # ブロッキングで待つ
-            fcntl.flock(fd, flag)
-            self._locked = True
+    def _flock(self, flag: int) -> None:
+        # まずノンブロッキングで試し、待たされる場合は待ち時間をログに出す
+        try:
+            fcntl.flock(self._fd, flag | fcntl.LOCK_NB)
             return
+        except OSError as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN): raise
+        logging.info(f"Waiting for {self.mode} lock on {self.lock_path}...")
+        start = time.monotonic()
 
-        # タイムアウトあり: ノンブロッキングでリトライ
-        deadline = time.monotonic() + self.timeout
-        while True:
-            try:
-                fcntl.flock(fd, flag | fcntl.LOCK_NB)
-                self._locked = True
-                return
-            except OSError as e:
-                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
-                    if time.monotonic() >= deadline:
-                        raise TimeoutError(
-                            f"Timeout while acquiring {self.mode} lock on {self.lock_path}"
-                        ) from None
-                    time.sleep(self.poll_interval)
-                else:
-                    raise
+        if self.timeout is None:
+            # ブロッキングで待つ
+            fcntl.flock(self._fd, flag)
+        else:
+            # タイムアウトあり: ノンブロッキングでリトライ
+            deadline = start + self.timeout
+            while True:
+                try:
+                    fcntl.flock(self._fd, flag | fcntl.LOCK_NB)
+                    break
+                except OSError as e:
+                    if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        if time.monotonic() >= deadline:
+                            raise TimeoutError(
+                                f"Timeout while acquiring {self.mode} lock on {self.lock_path}"
+                            ) from None
+                        time.sleep(self.poll_interval)
+                    else:
+                        raise
+        logging.info(f"Acquired {self.mode} lock on {self.lock_path} after waiting {time.monotonic() - start:.1f}s")
 
     def release(self) -> None:
         if self._locked and self._fd is not None:
@@ -134,6 +202,216 @@ class DirectoryLock:
     def __exit__(self, exc_type, exc, tb) -> None:
         self.release()
 
+class BuildReport:
+    """Wall time, CPU time of child processes and image growth of the phases and steps of a build.
+
+    Phases (lower, upper, pack) nest steps; every container command is a step, as are the host-side
+    operations worth watching (downloads, image setup, packing). CPU time is taken from the rusage of
+    waited-for children, except for commands of a build session whose container lives across steps;
+    those report the CPU time the session's dispatcher measured (see NspawnSession). Image growth is
+    the change of the space allocated to the images involved, i.e. roughly the new data written."""
+    def __init__(self):
+        self.phases = []
+        self._stack = []
+
+    @staticmethod
+    def _allocated(image):
+        return os.stat(image).st_blocks * 512 if os.path.exists(image) else 0
+
+    @contextlib.contextmanager
+    def _measure(self, kind, name, images):
+        entry = {"name": name}
+        (self._stack[-1].setdefault("steps", []) if self._stack else self.phases).append(entry)
+        if kind == "phase": entry["steps"] = []
+        self._stack.append(entry)
+        allocated = {image: self._allocated(image) for image in images}
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.monotonic()
+        try:
+            yield entry
+            entry["status"] = "ok"
+        except BaseException:
+            entry["status"] = "failed"
+            raise
+        finally:
+            self._stack.pop()
+            entry["wall"] = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            entry.setdefault("cpu_user", after.ru_utime - usage.ru_utime)
+            entry.setdefault("cpu_system", after.ru_stime - usage.ru_stime)
+            entry["image_growth"] = {image: self._allocated(image) - before for image, before in allocated.items()}
+
+    def phase(self, name, images=()):
+        return self._measure("phase", name, images)
+
+    def step(self, name, images=()):
+        return self._measure("step", name, images)
+
+    def write(self, path, **info):
+        with open(path + ".tmp", "w") as f:
+            json.dump(dict(info, time=time.time(), phases=self.phases), f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def log_summary(self):
+        if len(self.phases) == 0: return
+        #else
+        logging.info(f"{'Step':<60} {'Status':<7} {'Wall':>8} {'CPU':>8} {'Growth':>10}")
+        def log_entry(entry, indent):
+            growth = sum(entry["image_growth"].values()) / 1024 / 1024
+            name = (" " * indent + entry["name"])[:60]
+            logging.info(f"{name:<60} {entry['status']:<7} {entry['wall']:>7.1f}s "
+                         f"{entry['cpu_user'] + entry['cpu_system']:>7.1f}s {growth:>7.1f}MiB")
+            for step in entry.get("steps", []):
+                log_entry(step, indent + 2)
+        for phase in self.phases:
+            log_entry(phase, 0)
+
+build_report = BuildReport()
+
+def step_label(command):
+    label = command if isinstance(command, str) else shlex.join(command)
+    label = " ".join(label.split())
+    return label if len(label) <= 80 else label[:77] + "..."
+
+class NspawnOneShot:
+    """Runs each command in its own `genpack-helper nspawn` container."""
+    def __init__(self, lower_image, nspawn_opts=[]):
+        self.lower_image = lower_image
+        self.nspawn_opts = list(nspawn_opts)
+
+    def run(self, command, *, env=None, input=None, check=True):
+        """Run command (argv list, or a shell command line when str) and return its exit status."""
+        if isinstance(command, str): command = ["sh", "-c", command]
+        if isinstance(input, str): input = input.encode("utf-8")
+        opts = self.nspawn_opts + [f"--setenv={k}={v}" for k, v in (env or {}).items()]
+        if input is not None: opts.append("--console=pipe")
+        with build_report.step(step_label(command), self.images()):
+            return subprocess.run(["genpack-helper", "nspawn"] + opts + [self.lower_image] + command,
+                                  input=input, check=check).returncode
+
+    def images(self):
+        """The images commands of this container write to."""
+        return [self.lower_image] + [opt.partition("=")[2].rpartition(":")[0] for opt in self.nspawn_opts if opt.startswith("--overlay-image=")]
+
+    def __enter__(self) -> "NspawnOneShot":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+class NspawnSession(NspawnOneShot):
+    """A long-lived container serving all commands of one build phase.
+
+    Starting a container loop-mounts the images every time, which dominates phases made of
+    many short commands. Here a single container runs a small dispatcher loop instead; each
+    command is written as a script into a session directory under work/ (visible in the
+    container through /mnt/host) and announced on a FIFO, and its exit status comes back
+    on a second FIFO. stdout/stderr of the commands go straight to the container's console.
+    """
+    def __init__(self, lower_image, nspawn_opts=[]):
+        super().__init__(lower_image, nspawn_opts)
+        self._proc = None
+        self._seq = 0
+        self._status_buf = b""
+        self._children = (0.0, 0.0)
+
+    def __enter__(self) -> "NspawnSession":
+        self.session_dir = os.path.relpath(tempfile.mkdtemp(prefix="session-", dir=work_dir))
+        self._cmd_fd = self._status_fd = None
+        try:
+            self._start()
+        except BaseException:
+            # __exit__ does not run when __enter__ raises
+            for fd in (self._cmd_fd, self._status_fd):
+                if fd is not None: os.close(fd)
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+            raise
+        return self
+
+    def _start(self):
+        os.mkfifo(os.path.join(self.session_dir, "cmd"))
+        os.mkfifo(os.path.join(self.session_dir, "status"))
+        # O_RDWR never blocks on a FIFO and keeps both ends alive for the whole session
+        self._cmd_fd = os.open(os.path.join(self.session_dir, "cmd"), os.O_RDWR)
+        self._status_fd = os.open(os.path.join(self.session_dir, "status"), os.O_RDWR)
+        d = shlex.quote("/mnt/host/" + self.session_dir)
+        dispatcher = f"""cd /
+exec 3<{d}/cmd
+while read -r n <&3; do
+    [ "$n" = exit ] && break
+    if [ -f {d}/$n.in ]; then sh {d}/$n.sh <{d}/$n.in; else sh {d}/$n.sh </dev/null; fi
+    rc=$?
+    times >{d}/$n.times
+    echo "$n $rc" >{d}/status
+done"""
+        logging.debug(f"Starting build session container in {self.session_dir}")
+        self._proc = subprocess.Popen(["genpack-helper", "nspawn"] + self.nspawn_opts + [self.lower_image, "sh", "-c", dispatcher])
+
+    def run(self, command, *, env=None, input=None, check=True):
+        self._seq += 1
+        n = self._seq
+        lines = [f"export {k}={shlex.quote(str(v))}" for k, v in (env or {}).items()]
+        lines.append(command if isinstance(command, str) else shlex.join(command))
+        script_path = os.path.join(self.session_dir, f"{n}.sh")
+        input_path = os.path.join(self.session_dir, f"{n}.in")
+        with open(script_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        if input is not None:
+            with open(input_path, "wb") as f:
+                f.write(input.encode("utf-8") if isinstance(input, str) else input)
+        logging.debug(f"Build session command {n}: {lines[-1]}")
+        with build_report.step(step_label(command), self.images()) as entry:
+            os.write(self._cmd_fd, f"{n}\n".encode())
+            returncode = self._wait_status(n)
+            # the container outlives the step, so its CPU time comes from the dispatcher's `times`
+            times_path = os.path.join(self.session_dir, f"{n}.times")
+            children = self._read_times(times_path)
+            entry["cpu_user"], entry["cpu_system"] = children[0] - self._children[0], children[1] - self._children[1]
+            self._children = children
+            os.remove(times_path)
+        os.remove(script_path)
+        if input is not None: os.remove(input_path)
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        return returncode
+
+    @staticmethod
+    def _read_times(path):
+        """(user, system) CPU seconds of the dispatcher's children from the output of `times`."""
+        with open(path) as f:
+            lines = f.read().split("\n")
+        def seconds(value):
+            minutes, _, secs = value.rstrip("s").partition("m")
+            return int(minutes) * 60 + float(secs)
+        user, system = lines[1].split()
+        return seconds(user), seconds(system)
+
+    def _wait_status(self, n):
+        while True:
+            while b"\n" in self._status_buf:
+                line, _, self._status_buf = self._status_buf.partition(b"\n")
+                seq, returncode = line.split()
+                if int(seq) == n: return int(returncode)
+            ready, _, _ = select.select([self._status_fd], [], [], 1.0)
+            if ready:
+                self._status_buf += os.read(self._status_fd, 4096)
+            elif self._proc.poll() is not None:
+                raise RuntimeError(f"Build session container exited unexpectedly (exit status {self._proc.returncode})")
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if self._proc is not None and self._proc.poll() is None:
+                os.write(self._cmd_fd, b"exit\n")
+                self._proc.wait()
+        finally:
+            os.close(self._cmd_fd)
+            os.close(self._status_fd)
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+
+def nspawn_container(lower_image, nspawn_opts=[]):
+    """Container to run the commands of one build phase in; see NspawnSession."""
+    return NspawnSession(lower_image, nspawn_opts) if build_session else NspawnOneShot(lower_image, nspawn_opts)
+
 def find_binfmt_interpreter(target_arch, binfmt_dir="/proc/sys/fs/binfmt_misc"):
     """Find an enabled binfmt_misc entry whose ELF magic matches target_arch.
     Returns (interpreter, flags) or None."""
@@ -182,11 +460,24 @@ def check_cross_arch_executability():
             "re-register it with the 'F' flag.")
     logging.info(f"{arch} binaries will run via {interpreter} (binfmt flags: {flags})")
 
+_http_session = None
+
+def get_http_session():
+    """Return the pooled HTTP session shared by all mirror requests (thread-safe for our use)."""
+    global _http_session
+    if _http_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=3)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({'User-Agent': user_agent})
+        _http_session = session
+    return _http_session
+
 def url_readlines(url):
     """Read lines from a URL."""
     logging.debug(f"Reading lines from URL: {url}")
-    headers = {'User-Agent': user_agent}
-    response = requests.get(url, headers=headers)
+    response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
     response.raise_for_status()  # Raise an error for bad responses
     lines = response.text.splitlines()
     logging.debug(f"Read {len(lines)} lines from {url}")
@@ -201,8 +492,17 @@ def get_latest_stage3_tarball_url(stage3_variant = "systemd"):
     elif _arch == "riscv64":
         _arch = "riscv"
         _arch2 = "rv64_lp64d"
+    # the pointer file changes about once a week; reuse the resolved URL for a while
+    # instead of fetching it on every build
+    pointer_url = base_url + "releases/" + _arch + "/autobuilds/latest-stage3-" + _arch2 + "-%s.txt" % (stage3_variant,)
+    pointer_cache = os.path.join(cache_arch_dir, "latest-stage3-%s.url" % (stage3_variant,))
+    if os.path.isfile(pointer_cache) and time.time() - os.path.getmtime(pointer_cache) < STAGE3_POINTER_TTL:
+        cached_pointer_url, _, cached_stage3_url = open(pointer_cache).read().strip().partition("\n")
+        if cached_pointer_url == pointer_url and cached_stage3_url != "":
+            logging.debug(f"Using cached stage3 pointer {pointer_cache}")
+            return cached_stage3_url
     current_status = None
-    for line in url_readlines(base_url + "releases/" + _arch + "/autobuilds/latest-stage3-" + _arch2 + "-%s.txt" % (stage3_variant,)):
+    for line in url_readlines(pointer_url):
         if current_status is None:
             if line == "-----BEGIN PGP SIGNED MESSAGE-----": current_status = "header"
             continue
@@ -217,7 +517,11 @@ def get_latest_stage3_tarball_url(stage3_variant = "systemd"):
             splitted = line.split(" ")
             if len(splitted) < 2: continue
             #else
-            return base_url + "releases/" + _arch + "/autobuilds/" + splitted[0]
+            stage3_url = base_url + "releases/" + _arch + "/autobuilds/" + splitted[0]
+            os.makedirs(cache_arch_dir, exist_ok=True)
+            with open(pointer_cache, "w") as f:
+                f.write(f"{pointer_url}\n{stage3_url}\n")
+            return stage3_url
     #else
     raise Exception("No stage3 tarball (arch=%s,stage3_variant=%s) found", arch, stage3_variant)
 
@@ -225,42 +529,999 @@ def get_latest_portage_tarball_url():
     return base_url + "snapshots/portage-latest.tar.xz"
 
 def get_latest_overlay_tarball_url():
-    return "https://github.com/wbrxcorp/genpack-overlay/archive/refs/heads/main.tar.gz"
+    return overlay_url
 
 def headers_to_info(headers):
     return f"Last-Modified:{headers.get('Last-Modified', '')} ETag:{headers.get('ETag', '')} Content-Length:{headers.get('Content-Length', '')}"
 
-def get_headers(url):
-    """Get the headers of a URL."""
-    logging.debug(f"Getting headers for URL: {url}")
-    headers = {'User-Agent': user_agent}
-    response = requests.head(url, headers=headers, allow_redirects=True)
-    response.raise_for_status()  # Raise an error for bad responses
-    logging.debug(f"Headers for {url}: {response.headers}")
-    return response.headers
+def parse_headers_info(info):
+    """Inverse of headers_to_info()."""
+    m = re.fullmatch(r'Last-Modified:(.*) ETag:(.*) Content-Length:(.*)', info)
+    headers = requests.structures.CaseInsensitiveDict()
+    if m is None: return headers
+    #else
+    for key, value in zip(["Last-Modified", "ETag", "Content-Length"], m.groups()):
+        if value != "": headers[key] = value
+    return headers
+
+def link_or_copy(src, dest):
+    """Atomically place src at dest as a hardlink, falling back to a (reflink if possible) copy
+    when src and dest are on different filesystems."""
+    tmp = dest + ".tmp"
+    if os.path.lexists(tmp): os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+        #else
+        subprocess.run(["cp", "--reflink=auto", src, tmp], check=True)
+    os.replace(tmp, dest)
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def tree_fingerprint(path):
+    """sha256 over the names, modes, symlink targets and contents of everything under path
+    ('' if path doesn't exist)."""
+    if not os.path.exists(path): return ""
+    #else
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            full = os.path.join(root, name)
+            st = os.lstat(full)
+            h.update(f"{os.path.relpath(full, path)}\0{st.st_mode:o}\0".encode())
+            if os.path.islink(full):
+                h.update(os.readlink(full).encode())
+            elif os.path.isfile(full):
+                h.update(file_sha256(full).encode())
+    return h.hexdigest()
+
+LOWER_INPUTS = ["genpack.json5", "genpack.json", "savedconfig", "patches", "kernel", "env", "overlay"]
+
+def file_manifest(paths, previous=None):
+    """Map every file under paths to its mtime, size and sha256.
+    Files whose mtime and size match the previous manifest are not hashed again."""
+    previous = previous or {}
+    manifest = {}
+    def add(path):
+        st = os.lstat(path)
+        entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+        prev = previous.get(path)
+        if prev is not None and prev["mtime_ns"] == entry["mtime_ns"] and prev["size"] == entry["size"]:
+            entry["sha256"] = prev["sha256"]
+        elif os.path.islink(path):
+            entry["sha256"] = hashlib.sha256(os.readlink(path).encode()).hexdigest()
+        else:
+            entry["sha256"] = file_sha256(path)
+        manifest[path] = entry
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    add(os.path.join(root, name))
+                for name in dirs:
+                    if os.path.islink(os.path.join(root, name)): add(os.path.join(root, name))
+        elif os.path.lexists(path):
+            add(path)
+    return manifest
+
+def manifest_changes(old, new):
+    """Paths added, removed or modified (by content) between two manifests."""
+    return sorted(path for path in set(old) | set(new)
+                  if path not in old or path not in new or old[path]["sha256"] != new[path]["sha256"])
+
+# installed kernels get rebuilt when kernel/ changes; config.d only affects dist-kernels built from source
+DIST_KERNEL_PACKAGES = ["sys-kernel/gentoo-kernel", "sys-kernel/vanilla-kernel"]
+
+# packages whose single build is long and parallelizes well; under --parallel they get all make job slots
+DEFAULT_HEAVY_PACKAGES = DIST_KERNEL_PACKAGES + ["sys-devel/gcc", "llvm-core/llvm", "llvm-core/clang",
+                                                 "dev-lang/rust", "www-client/chromium", "dev-qt/qtwebengine"]
+
+# packages whose build tree may not fit in a tmpfs PORTAGE_TMPDIR; they build on the lower image's disk
+DEFAULT_TMPFS_EXCLUDED_PACKAGES = ["www-client/chromium", "dev-qt/qtwebengine", "app-office/libreoffice",
+                                   "dev-lang/rust", "llvm-core/llvm", "llvm-core/clang"]
+
+def read_ccache_stats(container, stats_file):
+    """Counters of the compiler cache as reported by `ccache --print-stats` in the container."""
+    container.run(f"ccache --print-stats > {shlex.quote('/mnt/host/' + stats_file)}")
+    stats = {}
+    with open(stats_file) as f:
+        for line in f:
+            key, _, value = line.strip().partition("\t")
+            if value.isdigit(): stats[key] = int(value)
+    os.remove(stats_file)
+    return stats
+
+def report_ccache_stats(before, after):
+    """Log the hit rate of the compilations between two read_ccache_stats() (other builds sharing
+    the cache at the same time are counted as well)."""
+    delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    hits = delta.get("direct_cache_hit", 0) + delta.get("preprocessed_cache_hit", 0)
+    misses = delta.get("cache_miss", 0)
+    if hits + misses == 0:
+        logging.info("ccache: no cacheable compilations in this build")
+        return
+    #else
+    logging.info(f"ccache: {hits} hits, {misses} misses ({hits * 100 / (hits + misses):.1f}% hit rate) in this build, "
+                 f"cache size {after.get('cache_size_kibibyte', 0) / 1024 / 1024:.1f} GiB")
+
+def available_memory():
+    """Memory available for new processes in bytes (MemAvailable of /proc/meminfo)."""
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"): return int(line.split()[1]) * 1024
+    #else
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+def plan_parallelism(config):
+    """Derive emerge --jobs, MAKEOPTS and the load limit for --parallel from the CPU count and available memory.
+
+    The number of concurrent compiler processes ("slots") is bounded by both CPUs and memory; they are
+    spread as about sqrt(slots) emerge jobs running make with slots/jobs each. Heavy packages are built
+    beforehand in an emerge pass of their own, one at a time with make -j slots (see
+    emerge_heavy_packages()), so they never share the memory the slots were derived from.
+    config is the 'parallel' object of genpack.json; values set there take precedence."""
+    nproc = os.cpu_count() or 1
+    memory_per_job = config.get("memory_per_job", MEMORY_PER_MAKE_JOB_IN_GIB)
+    slots = max(1, min(nproc, int(available_memory() / (memory_per_job * 1024 * 1024 * 1024))))
+    jobs = config.get("jobs", max(1, int(slots ** 0.5)))
+    plan = {
+        "jobs": jobs,
+        "make_jobs": config.get("make_jobs", max(1, slots // jobs)),
+        "heavy_make_jobs": config.get("heavy_make_jobs", slots),
+        "load_average": config.get("load_average", nproc),
+        "heavy_packages": config.get("heavy_packages", DEFAULT_HEAVY_PACKAGES),
+    }
+    logging.info(f"Parallel build plan: {plan['jobs']} emerge job(s) with make -j{plan['make_jobs']}, "
+                 f"heavy packages one at a time with -j{plan['heavy_make_jobs']}, load average limit {plan['load_average']}")
+    return plan
+
+def source_builds_cmd(emerge_cmd, dest):
+    """Shell command writing the CPVs emerge_cmd would build from source (as opposed to install from
+    binpkgs) to dest, one per line."""
+    dest = shlex.quote(f"/mnt/host/{dest}")
+    pretend = shlex.join(emerge_cmd + ["--pretend", "--quiet"])
+    return f"{pretend} 2>/dev/null | sed -n 's/^\\[ebuild[^]]*\\] *\\([^ ]*\\).*/\\1/p' > {dest}"
+
+def emerge_heavy_packages(container, emerge_cmd, targets, parallel_plan):
+    """Build the heavy packages that 'emerge_cmd targets' would compile in a pass of their own, one at a
+    time with make -j heavy_make_jobs, so that the parallel pass after it only has ordinary packages
+    left to run side by side. emerge_cmd must not carry the --jobs of the parallel plan."""
+    heavy = set(package_key(atom) for atom in parallel_plan["heavy_packages"])
+    if len(heavy) == 0: return
+    #else
+    builds_file = os.path.join(work_dir, f"source-builds-{os.getpid()}")
+    container.run(source_builds_cmd(emerge_cmd + targets, builds_file))
+    with open(builds_file) as f:
+        atoms = sorted(set(package_key(cpv) for cpv in f.read().split()) & heavy)
+    os.remove(builds_file)
+    if len(atoms) == 0: return
+    #else
+    logging.info(f"Emerging heavy packages one at a time: {' '.join(atoms)}")
+    container.run(emerge_cmd + ["--oneshot", "--jobs=1", f"--load-average={parallel_plan['load_average']}"] + atoms,
+                  env={"MAKEOPTS": f"-j{parallel_plan['heavy_make_jobs']} -l{parallel_plan['load_average']}"})
+
+def package_name_from_dir(name):
+    """Strip the optional :SLOT and version (P/PF form) from a patches/savedconfig directory name, giving PN."""
+    name = name.partition(":")[0]
+    return re.sub(r'-\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?$', "", name)
+
+def load_lower_record(variant):
+    """Inputs recorded when lower.done was written: {"files": manifest, "config": lower config}, or None."""
+    if not os.path.isfile(variant.lower_inputs): return None
+    #else
+    with open(variant.lower_inputs) as f:
+        record = json.load(f)
+    return record if isinstance(record, dict) and "files" in record and "config" in record else None
 
-def download(url, dest):
-    headers = {'User-Agent': user_agent}
-    response = requests.get(url, stream=True, headers=headers)
-    response.raise_for_status()  # Raise an error for bad responses
+def save_lower_record(variant, inputs, lower_config):
+    with open(variant.lower_inputs, "w") as f:
+        json.dump({"files": inputs, "config": lower_config}, f, indent=1)
+
+def plan_lower_update(variant, lower_config):
+    """Decide what it takes to bring the lower image up to date with its inputs.
 
-    with open(dest, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
+    Returns (inputs, plan). inputs is the current manifest of LOWER_INPUTS. plan is None when the
+    image is up to date, "full" when the whole emerge pipeline has to run, or a dict describing a
+    partial update: {"rebuild": [atoms to re-emerge from source], "kernel": bool, "mask": bool}.
+    """
+    record = load_lower_record(variant) if os.path.exists(variant.lower_done) else None
+    inputs = file_manifest(LOWER_INPUTS, record["files"] if record is not None else None)
+    if not os.path.exists(variant.lower_done): return inputs, "full"
+    #else
+    if record is None:
+        logging.info(f"No record of the inputs of {variant.lower_done}, rebuilding lower layer.")
+        return inputs, "full"
+    #else
+    current_world = variant.lower_world + ".current"
+    if os.path.isfile(current_world) and os.path.isfile(variant.lower_world) \
+            and file_sha256(current_world) != file_sha256(variant.lower_world):
+        logging.info(f"World file has changed since {variant.lower_done} was written, rebuilding lower layer.")
+        return inputs, "full"
+    #else
+    config_changes = sorted(k for k in set(record["config"]) | set(lower_config) if record["config"].get(k) != lower_config.get(k))
+    if any(k != "mask" for k in config_changes):
+        logging.info(f"Lower configuration changed ({', '.join(config_changes)}), rebuilding lower layer.")
+        return inputs, "full"
+    #else
+    plan = {"rebuild": [], "kernel": False, "mask": "mask" in config_changes}
+    env = lower_config.get("env", {})
+    for path in manifest_changes(record["files"], inputs):
+        parts = path.split("/")
+        if parts[0] in ("genpack.json5", "genpack.json"):
+            continue # what matters to lower is compared as lower_config above
+        elif parts[0] in ("patches", "savedconfig") and len(parts) >= 3:
+            atom = f"{parts[1]}/{package_name_from_dir(parts[2])}"
+            if atom not in plan["rebuild"]: plan["rebuild"].append(atom)
+        elif parts[0] == "overlay" and len(parts) >= 4 and parts[1] not in ("eclass", "metadata", "profiles", "licenses"):
+            atom = f"{parts[1]}/{parts[2]}"
+            if atom not in plan["rebuild"]: plan["rebuild"].append(atom)
+        elif parts[0] == "env" and len(parts) >= 2:
+            # env/ files take effect through package.env; rebuild the packages referring to this one
+            env_file = "/".join(parts[1:])
+            for atom, v in env.items():
+                if env_file in (v if isinstance(v, list) else [v]) and atom not in plan["rebuild"]:
+                    plan["rebuild"].append(atom)
+        elif parts[0] == "kernel":
+            plan["kernel"] = True
+        else:
+            logging.info(f"Change in {path} cannot be narrowed down, rebuilding lower layer.")
+            return inputs, "full"
+    if len(plan["rebuild"]) == 0 and not plan["kernel"] and not plan["mask"]:
+        # e.g. only upper-side settings in genpack.json changed, or only timestamps (git checkout)
+        if inputs != record["files"]:
+            save_lower_record(variant, inputs, lower_config)
+        return inputs, None
+    #else
+    logging.info(f"Partial lower update: rebuild={plan['rebuild']} kernel={plan['kernel']} mask={plan['mask']}")
+    return inputs, plan
+
+def copy_image(src, dest):
+    """Copy a sparse image file, sharing extents via reflink where the filesystem supports it."""
+    subprocess.run(["cp", "--reflink=auto", "--sparse=always", src, dest + ".tmp"], check=True)
+    os.replace(dest + ".tmp", dest)
+
+def create_image(image, size_in_gib):
+    """Create an empty ext4 image of size_in_gib at image.
+
+    The image is cloned from a pre-formatted template of the same size (reflinked where the
+    filesystem supports it, otherwise a sparse copy), so mkfs only runs the first time a
+    size is used on this host."""
+    template = os.path.join(image_template_dir, f"ext4-nojournal-{size_in_gib}G.img")
+    with DirectoryLock(image_template_dir):
+        if not os.path.isfile(template):
+            logging.info(f"Creating {size_in_gib} GiB filesystem template {template}")
+            with open(template + ".tmp", "wb") as f:
+                f.truncate(size_in_gib * 1024 * 1024 * 1024)
+            try:
+                subprocess.run(['mkfs.ext4', '-q', '-O', '^has_journal', template + ".tmp"], check=True)
+            except:
+                os.remove(template + ".tmp")
+                raise
+            os.replace(template + ".tmp", template)
+    if os.path.isfile(image):
+        os.remove(image)
+    logging.info(f"Creating image file at {image} with size {size_in_gib} GiB.")
+    copy_image(template, image)
+
+def tarball_cache_key(url, headers):
+    """Cache key of the content served at url as described by its validators, or None if the
+    server sends neither ETag nor Last-Modified (content cannot be identified then)."""
+    if not headers.get("ETag") and not headers.get("Last-Modified"): return None
+    #else
+    return hashlib.sha256(f"{url}\n{headers_to_info(headers)}".encode()).hexdigest()
+
+def load_tarball_cache_index():
+    index_path = os.path.join(tarball_cache_dir, "index.json")
+    if not os.path.isfile(index_path): return {}
+    #else
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Tarball cache index {index_path} is corrupt, starting with an empty one.")
+        return {}
+
+def save_tarball_cache_index(index):
+    index_path = os.path.join(tarball_cache_dir, "index.json")
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+
+def tarball_cache_fetch(url, headers, dest):
+    """Place the cached copy of url (identified by headers) at dest. Returns True on a cache hit."""
+    key = tarball_cache_key(url, headers)
+    if key is None: return False
+    #else
+    with DirectoryLock(tarball_cache_dir):
+        index = load_tarball_cache_index()
+        entry = index.get(key)
+        if entry is None: return False
+        #else
+        obj = os.path.join(tarball_cache_dir, "objects", entry["sha256"])
+        if not os.path.isfile(obj):
+            del index[key]
+            save_tarball_cache_index(index)
+            return False
+        #else
+        link_or_copy(obj, dest)
+        entry["last_used"] = time.time()
+        save_tarball_cache_index(index)
+    logging.info(f"Using cached copy of {url} ({entry['sha256'][:12]})")
+    return True
+
+def tarball_cache_store(url, headers, src):
+    """Add a freshly downloaded tarball to the shared cache (content-addressed by sha256)."""
+    key = tarball_cache_key(url, headers)
+    if key is None: return
+    #else
+    sha256 = file_sha256(src)
+    with DirectoryLock(tarball_cache_dir):
+        objects_dir = os.path.join(tarball_cache_dir, "objects")
+        os.makedirs(objects_dir, exist_ok=True)
+        obj = os.path.join(objects_dir, sha256)
+        if not os.path.isfile(obj):
+            link_or_copy(src, obj)
+        index = load_tarball_cache_index()
+        index[key] = {"url": url, "info": headers_to_info(headers), "sha256": sha256,
+                      "size": os.path.getsize(obj), "last_used": time.time()}
+        save_tarball_cache_index(index)
+        prune_tarball_cache(DEFAULT_TARBALL_CACHE_SIZE_IN_GIB * 1024 * 1024 * 1024, locked=True)
+
+def prune_tarball_cache(max_size, locked=False):
+    """Evict least recently used objects until the tarball cache fits in max_size bytes.
+    Returns the number of bytes freed."""
+    if not locked:
+        with DirectoryLock(tarball_cache_dir):
+            return prune_tarball_cache(max_size, locked=True)
+    #else
+    index = load_tarball_cache_index()
+    objects = {}  # sha256 -> (last_used, size)
+    for entry in index.values():
+        last_used, size = objects.get(entry["sha256"], (0.0, entry["size"]))
+        objects[entry["sha256"]] = (max(last_used, entry["last_used"]), size)
+    total = sum(size for _, size in objects.values())
+    freed = 0
+    for sha256, (last_used, size) in sorted(objects.items(), key=lambda x: x[1][0]):
+        if total <= max_size: break
+        #else
+        logging.info(f"Evicting {sha256[:12]} ({size} bytes) from tarball cache")
+        obj = os.path.join(tarball_cache_dir, "objects", sha256)
+        if os.path.isfile(obj): os.remove(obj)
+        for key in [k for k, v in index.items() if v["sha256"] == sha256]:
+            del index[key]
+        total -= size
+        freed += size
+    save_tarball_cache_index(index)
+    return freed
+
+def cache_command(argv):
+    """`genpack cache [list|prune|packages]`: inspect and prune the shared tarball cache, or show the emerge history."""
+    cache_parser = argparse.ArgumentParser(prog="genpack cache", description="Inspect or prune the shared tarball cache, or show the per-package emerge history")
+    cache_parser.add_argument("subaction", choices=["list", "prune", "packages"], nargs="?", default="list")
+    cache_parser.add_argument("--max-size", type=float, default=DEFAULT_TARBALL_CACHE_SIZE_IN_GIB, help="Size budget in GiB for 'prune'")
+    cache_args = cache_parser.parse_args(argv)
+    if cache_args.subaction == "packages":
+        with DirectoryLock(cache_arch_dir, lock_filename=".history.lock") if os.path.isdir(cache_arch_dir) else contextlib.nullcontext():
+            history = load_emerge_history()
+        # the packages costing the most compile time first
+        for key, entry in sorted(history.items(), key=lambda x: x[1]["build_time"], reverse=True):
+            print(f"{key:<40} {entry['build_time'] / 60:8.1f} min  {entry['source_builds']:4d} built  {entry['binpkg_installs']:4d} binpkg"
+                  + (f"  last: {entry['last_reason']} ({entry['last_artifact']})" if "last_reason" in entry else ""))
+        print(f"{len(history)} packages ({emerge_history_path()})")
+        return
+    #else
+    if cache_args.subaction == "prune":
+        freed = prune_tarball_cache(int(cache_args.max_size * 1024 * 1024 * 1024))
+        print(f"Freed {freed / 1024 / 1024:.1f} MiB")
+        return
+    #else
+    with DirectoryLock(tarball_cache_dir, mode="shared"):
+        index = load_tarball_cache_index()
+    total = 0
+    seen = set()
+    for entry in sorted(index.values(), key=lambda x: x["last_used"], reverse=True):
+        last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+        print(f"{entry['sha256'][:12]}  {entry['size'] / 1024 / 1024:10.1f} MiB  {last_used}  {entry['url']}")
+        if entry["sha256"] not in seen:
+            seen.add(entry["sha256"])
+            total += entry["size"]
+    print(f"Total: {total / 1024 / 1024:.1f} MiB in {len(seen)} objects ({tarball_cache_dir})")
+
+def mirror_path(url):
+    """Where a genpack mirror serves the tarball fetched from url: its URL path, relative to the
+    Gentoo mirror root for stage3 and portage tarballs (mirrors may keep Gentoo in a subdirectory)."""
+    path = urllib.parse.urlparse(url).path.lstrip("/")
+    m = re.search(r'(?:^|/)((?:releases|snapshots)/.+)$', path)
+    return m.group(1) if m is not None else path
+
+def mirror_index():
+    """Path on a genpack mirror -> the entry of the tarball cache served there (the most recently
+    used one when a URL was cached with different contents over time)."""
+    with DirectoryLock(tarball_cache_dir, mode="shared"):
+        index = load_tarball_cache_index()
+    paths = {}
+    for entry in sorted(index.values(), key=lambda x: x["last_used"]):
+        if os.path.isfile(os.path.join(tarball_cache_dir, "objects", entry["sha256"])):
+            paths[mirror_path(entry["url"])] = entry
+    return paths
+
+def mirror_stage3_pointer(paths, path):
+    """Contents of a latest-stage3-*.txt pointer file pointing to the newest cached stage3 it covers,
+    in the clearsigned layout of the Gentoo one (unsigned), or None if no such stage3 is cached."""
+    m = re.fullmatch(r'releases/([^/]+)/autobuilds/latest-(stage3-.+)\.txt', path)
+    if m is None: return None
+    #else
+    autobuilds = f"releases/{m.group(1)}/autobuilds/"
+    candidates = sorted(p[len(autobuilds):] for p in paths
+                        if p.startswith(autobuilds) and re.fullmatch(re.escape(m.group(2)) + r'-\d[^/]*\.tar\.xz', p.rpartition("/")[2]))
+    if len(candidates) == 0: return None
+    #else
+    latest = candidates[-1]  # the stage3 file names carry the build timestamp
+    return ("-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n"
+            f"# served by genpack mirror\n{latest} {paths[autobuilds + latest]['size']}\n"
+            "-----BEGIN PGP SIGNATURE-----\n-----END PGP SIGNATURE-----\n")
+
+class MirrorRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the shared caches the way genpack and portage fetch from a mirror: cached tarballs
+    at the path of the URL they were downloaded from (with the validators of the original server,
+    so conditional and range requests of fetch_tarball() work), generated stage3 pointer files
+    and the shared distfiles under distfiles/."""
+    server_version = "genpack-mirror"
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+    def serve(self, send_body):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip("/")
+        if ".." in path.split("/"):
+            self.send_error(400)
+            return
+        #else
+        name = path.removeprefix("distfiles/")
+        if path.startswith("distfiles/") and "/" not in name and not name.startswith("."):
+            file = os.path.join(distfiles_dir, "files", name)
+            if not os.path.isfile(file):
+                self.send_error(404)
+                return
+            #else
+            st = os.stat(file)
+            headers = {"Last-Modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(st.st_mtime))}
+            self.send_file(open(file, "rb"), st.st_size, headers, send_body)
+            return
+        #else
+        paths = mirror_index()
+        pointer = mirror_stage3_pointer(paths, path)
+        if pointer is not None:
+            self.send_file(io.BytesIO(pointer.encode()), len(pointer.encode()), {}, send_body)
+            return
+        #else
+        entry = paths.get(path)
+        if entry is None:
+            self.send_error(404)
+            return
+        #else
+        headers = parse_headers_info(entry["info"])
+        headers.pop("Content-Length", None)
+        # opened before anything else can happen to the cache; the object may be pruned meanwhile
+        self.send_file(open(os.path.join(tarball_cache_dir, "objects", entry["sha256"]), "rb"), entry["size"], headers, send_body)
+
+    def send_file(self, f, size, headers, send_body):
+        with f:
+            etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+            if (etag is not None and self.headers.get("If-None-Match") == etag) or \
+                    (etag is None and last_modified is not None and self.headers.get("If-Modified-Since") == last_modified):
+                self.send_response(304)
+                for k, v in headers.items(): self.send_header(k, v)
+                self.end_headers()
+                return
+            #else
+            start = 0
+            m = re.fullmatch(r'bytes=(\d+)-', self.headers.get("Range", ""))
+            if_range = self.headers.get("If-Range")
+            if m is not None and int(m.group(1)) < size and (if_range is None or if_range in (etag, last_modified)):
+                start = int(m.group(1))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+            else:
+                self.send_response(200)
+            for k, v in headers.items(): self.send_header(k, v)
+            self.send_header("Content-Length", str(size - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if not send_body: return
+            #else
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+
+def mirror_command(argv):
+    """`genpack mirror [list|serve]`: serve the shared tarball and distfiles caches over HTTP as a local mirror."""
+    mirror_parser = argparse.ArgumentParser(prog="genpack mirror", description="Serve the shared tarball and distfiles caches as a local mirror")
+    mirror_parser.add_argument("subaction", choices=["list", "serve"], nargs="?", default="list")
+    mirror_parser.add_argument("--bind", default="0.0.0.0", help="Address to listen on for 'serve' (default: all)")
+    mirror_parser.add_argument("--port", type=int, default=DEFAULT_MIRROR_PORT, help=f"Port to listen on for 'serve' (default: {DEFAULT_MIRROR_PORT})")
+    mirror_args = mirror_parser.parse_args(argv)
+    paths = mirror_index()
+    if mirror_args.subaction == "list":
+        for path, entry in sorted(paths.items()):
+            print(f"{entry['size'] / 1024 / 1024:10.1f} MiB  {path}")
+        print(f"{len(paths)} tarballs ({tarball_cache_dir}), distfiles from {os.path.join(distfiles_dir, 'files')}")
+        return
+    #else
+    server = http.server.ThreadingHTTPServer((mirror_args.bind, mirror_args.port), MirrorRequestHandler)
+    url = f"http://{socket.gethostname() if mirror_args.bind == '0.0.0.0' else mirror_args.bind}:{mirror_args.port}/"
+    logging.info(f"Serving {len(paths)} cached tarballs and the shared distfiles at {url}")
+    overlay_path = mirror_path(DEFAULT_OVERLAY_URL)
+    logging.info(f"Build against it with: genpack --mirror {url} --overlay-url {url}{overlay_path}"
+                 + ("" if overlay_path in paths else " (the overlay tarball is not cached yet)"))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def parse_binpkg_index(text):
+    """Split a portage binhost 'Packages' index into (header, [package entries]), each a dict of its fields."""
+    blocks = [[line.split(": ", 1) for line in block.splitlines() if ": " in line] for block in text.split("\n\n")]
+    blocks = [dict(block) for block in blocks if len(block) > 0]
+    if len(blocks) == 0: return {}, []
+    #else
+    return blocks[0], blocks[1:]
+
+def format_binpkg_index(header, entries):
+    header = dict(header, PACKAGES=str(len(entries)), TIMESTAMP=str(int(time.time())))
+    return "\n\n".join("\n".join(f"{k}: {v}" for k, v in block.items()) for block in [header] + entries) + "\n"
+
+def binpkg_entry_path(entry):
+    """Location of a binpkg relative to PKGDIR (PATH is set with binpkg-multi-instance)."""
+    path = entry.get("PATH") or entry["CPV"] + ".tbz2"
+    if path.startswith("/") or ".." in path.split("/"):
+        raise ValueError(f"Refusing binpkg path {path} from index")
+    #else
+    return path
+
+def binhost_url(binhost, profile, use):
+    """Binhost location for this build: packages are kept apart by arch, profile and USE settings."""
+    profile_key = (profile or "default").replace("/", "_")
+    use_key = hashlib.sha256(json.dumps(use, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{binhost.rstrip('/')}/{arch}/{profile_key}/{use_key}"
+
+def binhost_local_path(url):
+    """Directory of a file:// binhost (or a plain path), None for HTTP ones."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme in ("http", "https"): return None
+    #else
+    return urllib.parse.unquote(parsed.path) if parsed.scheme == "file" else url
+
+def binhost_read_index(url):
+    local = binhost_local_path(url)
+    if local is not None:
+        index_path = os.path.join(local, "Packages")
+        return parse_binpkg_index(open(index_path).read()) if os.path.isfile(index_path) else ({}, [])
+    #else
+    response = get_http_session().get(url + "/Packages", timeout=HTTP_TIMEOUT)
+    if response.status_code == 404: return {}, []
+    #else
+    response.raise_for_status()
+    return parse_binpkg_index(response.text)
+
+def fetch_binpkg(url, local, path, f):
+    """Write the binpkg at path of the binhost at url (local: its directory for file:// ones) to f.
+    Returns False if the binhost does not have it."""
+    if local is not None:
+        if not os.path.isfile(os.path.join(local, path)): return False
+        #else
+        with open(os.path.join(local, path), "rb") as src:
+            shutil.copyfileobj(src, f)
+        return True
+    #else
+    with get_http_session().get(f"{url}/{path}", stream=True, timeout=HTTP_TIMEOUT) as response:
+        if response.status_code == 404: return False
+        #else
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
             f.write(chunk)
+    return True
+
+def pull_binpkgs(url):
+    """Copy the binpkgs of the binhost at url that binpkgs_dir lacks. Returns the number pulled;
+    the caller has to reindex binpkgs_dir (emaint binhost --fix) when it is non-zero."""
+    _, entries = binhost_read_index(url)
+    local = binhost_local_path(url)
+    pulled = 0
+    for entry in entries:
+        path = binpkg_entry_path(entry)
+        dest = os.path.join(binpkgs_dir, path)
+        if os.path.exists(dest): continue
+        #else
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # a temporary file of our own: concurrent builds (holding the binpkgs lock shared, like this
+        # one) may pull the same package at the same time
+        fd, part = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=os.path.basename(dest) + ".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if not fetch_binpkg(url, local, path, f): continue
+            #else
+            if "SIZE" in entry and os.path.getsize(part) != int(entry["SIZE"]):
+                logging.warning(f"Size of {path} from binhost does not match its index, skipping it.")
+                continue
+            #else
+            os.chmod(part, 0o644)
+            os.replace(part, dest)
+            pulled += 1
+        finally:
+            if os.path.exists(part): os.remove(part)
+    logging.info(f"Pulled {pulled} binary package(s) from {url}")
+    return pulled
+
+def push_binpkgs(url, since):
+    """Upload the binpkgs built at or after since (epoch seconds) that the binhost at url lacks, and
+    merge them into its index. Returns the number pushed."""
+    local_header, local_entries = parse_binpkg_index(open(os.path.join(binpkgs_dir, "Packages")).read()) \
+        if os.path.isfile(os.path.join(binpkgs_dir, "Packages")) else ({}, [])
+    local = binhost_local_path(url)
+    with DirectoryLock(local) if local is not None else contextlib.nullcontext():
+        _, remote_entries = binhost_read_index(url)
+        remote_paths = set(binpkg_entry_path(entry) for entry in remote_entries)
+        pushed = []
+        for entry in local_entries:
+            path = binpkg_entry_path(entry)
+            if path in remote_paths or int(entry.get("BUILD_TIME", "0")) < since: continue
+            #else
+            src = os.path.join(binpkgs_dir, path)
+            if not os.path.isfile(src): continue
+            #else
+            if local is not None:
+                os.makedirs(os.path.dirname(os.path.join(local, path)), exist_ok=True)
+                shutil.copyfile(src, os.path.join(local, path) + ".tmp")
+                os.replace(os.path.join(local, path) + ".tmp", os.path.join(local, path))
+            else:
+                with open(src, "rb") as f:
+                    get_http_session().put(f"{url}/{path}", data=f, timeout=HTTP_TIMEOUT).raise_for_status()
+            pushed.append(entry)
+        if len(pushed) > 0:
+            index = format_binpkg_index(local_header, remote_entries + pushed)
+            if local is not None:
+                with open(os.path.join(local, "Packages.tmp"), "w") as f:
+                    f.write(index)
+                os.replace(os.path.join(local, "Packages.tmp"), os.path.join(local, "Packages"))
+            else:
+                # concurrent pushes to an HTTP binhost race on the index; the last one wins
+                get_http_session().put(url + "/Packages", data=index.encode(), timeout=HTTP_TIMEOUT).raise_for_status()
+    logging.info(f"Pushed {len(pushed)} binary package(s) to {url}")
+    return len(pushed)
+
+def binpkg_usage_path(binpkgs):
+    return os.path.join(os.path.dirname(binpkgs), "binpkgs-usage.json")
+
+def load_binpkg_usage(binpkgs):
+    """{consumer: {"time": epoch, "packages": [paths relative to binpkgs]}} recorded by lower builds."""
+    usage_path = binpkg_usage_path(binpkgs)
+    if not os.path.isfile(usage_path): return {}
+    #else
+    try:
+        with open(usage_path) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Binpkg usage record {usage_path} is corrupt, starting with an empty one.")
+        return {}
+
+def save_binpkg_usage(binpkgs, usage):
+    usage_path = binpkg_usage_path(binpkgs)
+    with open(usage_path + ".tmp", "w") as f:
+        json.dump(usage, f, indent=1)
+    os.replace(usage_path + ".tmp", usage_path)
+
+def installed_packages_cmd(dest):
+    """Shell command listing 'CPV BUILD_ID' of the packages installed in the lower image to dest."""
+    dest = shlex.quote(f"/mnt/host/{dest}")
+    return f'for d in /var/db/pkg/*/*; do [ -d "$d" ] && echo "${{d#/var/db/pkg/}} $(cat "$d/BUILD_ID" 2>/dev/null)"; done > {dest}'
+
+def record_binpkg_usage(variant):
+    """Remember which binpkgs of the shared cache the lower image of variant consists of, for 'genpack gc'."""
+    installed = {}
+    with open(variant.lower_packages) as f:
+        for line in f:
+            cpv, _, build_id = line.strip().partition(" ")
+            if cpv: installed.setdefault(cpv, set()).add(build_id)
+    index_path = os.path.join(binpkgs_dir, "Packages")
+    _, entries = parse_binpkg_index(open(index_path).read()) if os.path.isfile(index_path) else ({}, [])
+    used = sorted(set(binpkg_entry_path(entry) for entry in entries if entry.get("CPV") in installed
+                      and ("BUILD_ID" not in entry or "" in installed[entry["CPV"]] or entry["BUILD_ID"] in installed[entry["CPV"]])))
+    consumer = os.path.abspath(".") + ("" if variant.name is None else f"#{variant.name}")
+    with DirectoryLock(cache_arch_dir, lock_filename=".usage.lock"):
+        usage = load_binpkg_usage(binpkgs_dir)
+        usage[consumer] = {"time": time.time(), "packages": used}
+        save_binpkg_usage(binpkgs_dir, usage)
+    logging.info(f"Recorded use of {len(used)} binary package(s) from {binpkgs_dir}")
+
+EMERGE_LOG_LINE = re.compile(r'^(\d+):\s+(>>> emerge|=== \(\d+ of \d+\) Merging Binary|::: completed emerge) \(?(?:\d+ of \d+\) )?(\S+?)(?:::| to )')
+
+def emerge_log_size_cmd(dest):
+    """Shell command writing the current size of the lower image's emerge.log to dest."""
+    dest = shlex.quote(f"/mnt/host/{dest}")
+    return f"stat -c %s /var/log/emerge.log > {dest} 2>/dev/null || echo 0 > {dest}"
+
+def emerge_log_tail_cmd(offset, dest):
+    """Shell command copying what was appended to the lower image's emerge.log after offset to dest."""
+    dest = shlex.quote(f"/mnt/host/{dest}")
+    return f"if [ -f /var/log/emerge.log ]; then tail -c +{offset + 1} /var/log/emerge.log; fi > {dest}"
+
+def parse_emerge_log(text):
+    """Merges found in (a portion of) emerge.log, in the order they started:
+    [{"cpv", "binary", "start", "duration", "status"}]. duration is None for merges that did not complete."""
+    merges = {}
+    for line in text.splitlines():
+        m = EMERGE_LOG_LINE.match(line)
+        if m is None: continue
+        #else
+        timestamp, event, cpv = int(m.group(1)), m.group(2), m.group(3)
+        if event == ">>> emerge":
+            # a later attempt (e.g. @preserved-rebuild) replaces the earlier one of the same package
+            merges.pop(cpv, None)
+            merges[cpv] = {"cpv": cpv, "binary": False, "start": timestamp, "duration": None, "status": "failed"}
+        elif cpv in merges and event.startswith("==="):
+            merges[cpv]["binary"] = True
+        elif cpv in merges:
+            merges[cpv]["duration"] = timestamp - merges[cpv]["start"]
+            merges[cpv]["status"] = "ok"
+    return list(merges.values())
+
+def package_key(atom):
+    """cat/pn of a CPV or a dependency atom (operators, version, slot and repository stripped)."""
+    category, _, name = re.sub(r'^[<>=~!]+', "", atom).partition("/")
+    return f"{category}/{package_name_from_dir(name.partition('::')[0])}"
+
+def load_installed_packages(path):
+    """cat/pn -> set of CPVs from a list written by installed_packages_cmd(), or None if there is none."""
+    if not os.path.isfile(path): return None
+    #else
+    installed = {}
+    with open(path) as f:
+        for line in f:
+            cpv = line.strip().partition(" ")[0]
+            if cpv: installed.setdefault(package_key(cpv), set()).add(cpv)
+    return installed
+
+def emerge_build_reason(cpv, previous, plan):
+    """Why a package was built from source instead of installed from a binpkg, as far as we can tell."""
+    key = package_key(cpv)
+    if plan != "full" and key in set(package_key(atom) for atom in plan["rebuild"]):
+        return "inputs changed (patches, savedconfig, overlay or env)"
+    #else
+    if plan != "full" and plan["kernel"] and key in DIST_KERNEL_PACKAGES:
+        return "kernel configuration changed"
+    #else
+    if previous is None:
+        return "initial build"
+    #else
+    if key not in previous:
+        return "new package"
+    #else
+    if cpv not in previous[key]:
+        return f"version change from {', '.join(sorted(previous[key]))}"
+    #else
+    return "rebuild (USE flags, dependencies, binpkg_excludes or no matching binpkg)"
+
+def emerge_report(merges, previous, plan):
+    """Annotate the merges of parse_emerge_log() with the reason for each source build."""
+    for merge in merges:
+        merge["reason"] = "binpkg" if merge["binary"] else emerge_build_reason(merge["cpv"], previous, plan)
+    return merges
+
+def log_emerge_report(merges):
+    built = [merge for merge in merges if not merge["binary"]]
+    failed = [merge for merge in merges if merge["status"] != "ok"]
+    logging.info(f"Emerge: {len(merges) - len(built)} binpkg hit(s), {len(built)} source build(s)"
+                 + (f", {len(failed)} failed" if len(failed) > 0 else ""))
+    for merge in sorted(built, key=lambda x: x["duration"] or 0, reverse=True)[:10]:
+        duration = "failed" if merge["duration"] is None else f"{merge['duration']}s"
+        logging.info(f"  {merge['cpv']:<50} {duration:>8}  {merge['reason']}")
+
+def emerge_history_path():
+    return os.path.join(cache_arch_dir, "emerge-history.json")
+
+def load_emerge_history():
+    """{cat/pn: totals of its merges by all lower builds of this architecture}, see update_emerge_history()."""
+    history_path = emerge_history_path()
+    if not os.path.isfile(history_path): return {}
+    #else
+    try:
+        with open(history_path) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Emerge history {history_path} is corrupt, starting with an empty one.")
+        return {}
+
+def update_emerge_history(merges, artifact):
+    """Add the merges of a lower build to the per-package history shared by all projects."""
+    os.makedirs(cache_arch_dir, exist_ok=True)
+    with DirectoryLock(cache_arch_dir, lock_filename=".history.lock"):
+        history = load_emerge_history()
+        for merge in merges:
+            if merge["status"] != "ok": continue
+            #else
+            entry = history.setdefault(package_key(merge["cpv"]), {"source_builds": 0, "binpkg_installs": 0, "build_time": 0})
+            if merge["binary"]:
+                entry["binpkg_installs"] += 1
+                continue
+            #else
+            entry["source_builds"] += 1
+            entry["build_time"] += merge["duration"]
+            entry.update(last_cpv=merge["cpv"], last_build_time=merge["duration"], last_reason=merge["reason"],
+                         last_artifact=artifact, last_time=merge["start"])
+        history_path = emerge_history_path()
+        with open(history_path + ".tmp", "w") as f:
+            json.dump(history, f, indent=1)
+        os.replace(history_path + ".tmp", history_path)
+
+def gc_binpkgs(max_size, max_age=None, dry_run=False):
+    """Evict binpkgs from the shared caches of all architectures, least recently used first, until
+    they fit in max_size bytes; with max_age (seconds), also evict everything unused for that long.
+    A binpkg was last used when a lower build last recorded it (or when it was written, if never).
+    Returns the number of bytes freed."""
+    binpkgs_dirs = sorted(d for d in (os.path.join(cache_root, a, "binpkgs") for a in ELF_MACHINE) if os.path.isdir(d))
+    with contextlib.ExitStack() as stack:
+        for d in binpkgs_dirs:
+            stack.enter_context(DirectoryLock(d, mode="exclusive"))
+            stack.enter_context(DirectoryLock(os.path.dirname(d), lock_filename=".usage.lock"))
+        candidates = []  # (last_used, size, binpkgs dir, path)
+        for d in binpkgs_dirs:
+            usage = load_binpkg_usage(d)
+            # projects that no longer exist do not keep their packages alive
+            usage = {k: v for k, v in usage.items() if os.path.isdir(k.partition("#")[0])}
+            save_binpkg_usage(d, usage)
+            last_used = {}
+            for record in usage.values():
+                for path in record["packages"]:
+                    last_used[path] = max(last_used.get(path, 0), record["time"])
+            for root, _, files in os.walk(d):
+                for name in files:
+                    full = os.path.join(root, name)
+                    path = os.path.relpath(full, d)
+                    if name in ("Packages", ".dirlock") or name.endswith(".part"): continue
+                    #else
+                    st = os.stat(full)
+                    candidates.append((last_used.get(path, st.st_mtime), st.st_size, d, path))
+        total = sum(size for _, size, _, _ in candidates)
+        now = time.time()
+        freed = 0
+        removed = {}  # binpkgs dir -> set of paths
+        for last_used, size, d, path in sorted(candidates):
+            if total <= max_size and (max_age is None or now - last_used < max_age): continue
+            #else
+            logging.info(f"{'Would evict' if dry_run else 'Evicting'} {os.path.join(d, path)} ({size} bytes, last used {time.strftime('%Y-%m-%d', time.localtime(last_used))})")
+            if not dry_run: os.remove(os.path.join(d, path))
+            removed.setdefault(d, set()).add(path)
+            total -= size
+            freed += size
+        if not dry_run:
+            for d, paths in removed.items():
+                index_path = os.path.join(d, "Packages")
+                if not os.path.isfile(index_path): continue
+                #else
+                header, entries = parse_binpkg_index(open(index_path).read())
+                with open(index_path + ".tmp", "w") as f:
+                    f.write(format_binpkg_index(header, [e for e in entries if binpkg_entry_path(e) not in paths]))
+                os.replace(index_path + ".tmp", index_path)
+    return freed
+
+def gc_command(argv):
+    """`genpack gc`: shrink the shared binpkg caches of all projects to a size budget."""
+    gc_parser = argparse.ArgumentParser(prog="genpack gc", description="Evict least recently used binary packages from the shared binpkg caches")
+    gc_parser.add_argument("--max-size", type=float, default=DEFAULT_BINPKG_CACHE_SIZE_IN_GIB, help="Size budget in GiB across all architectures")
+    gc_parser.add_argument("--max-age", type=float, default=None, help="Also evict binary packages unused for this many days")
+    gc_parser.add_argument("--dry-run", action="store_true", help="Only show what would be evicted")
+    gc_args = gc_parser.parse_args(argv)
+    freed = gc_binpkgs(int(gc_args.max_size * 1024 * 1024 * 1024),
+                       None if gc_args.max_age is None else gc_args.max_age * 86400, gc_args.dry_run)
+    print(f"{'Would free' if gc_args.dry_run else 'Freed'} {freed / 1024 / 1024:.1f} MiB")
+
+def reuse_tarball(dest, saved_headers_path, url=None):
+    """Use dest as is without touching the network. When url is given, dest must have been fetched from it.
+    Returns (headers, is_new) like fetch_tarball(), or None when dest cannot be reused."""
+    if not os.path.isfile(dest): return None
+    #else
+    recorded_url = open(dest + ".url").read().strip() if os.path.isfile(dest + ".url") else None
+    if url is not None and url != recorded_url: return None
+    #else
+    if os.path.isfile(saved_headers_path):
+        return parse_headers_info(open(saved_headers_path).read().strip()), False
+    #else
+    # downloaded, but not applied to a lower image yet
+    return requests.structures.CaseInsensitiveDict(), True
+
+def fetch_tarball(url, dest, saved_headers_path, description):
+    """Bring dest up to date with url using a single (conditional) GET.
+
+    When dest was applied before, the request carries If-None-Match/If-Modified-Since built from the
+    headers recorded at saved_headers_path, so an unchanged tarball costs one 304 round trip.
+    An interrupted transfer leaves dest.part (+ .part.info) behind and is resumed with Range/If-Range;
+    one interrupted after the last byte was written is completed without a request.
+    Returns (headers, is_new). The caller records the headers once the tarball has been applied."""
+    part = dest + ".part"
+    part_info_path = part + ".info"
+    saved_info = open(saved_headers_path).read().strip() if os.path.isfile(saved_headers_path) else None
+    request_headers = {}
+    if os.path.isfile(part) and os.path.isfile(part_info_path):
+        part_headers = parse_headers_info(open(part_info_path).read().strip())
+        if part_headers.get("Content-Length") == str(os.path.getsize(part)):
+            logging.info(f"Download of {url} was complete but not finalized, using it.")
+            return finish_download(url, part, dest, part_headers), True
+        #else
+        validator = part_headers.get("ETag") or part_headers.get("Last-Modified")
+        if validator:
+            request_headers["Range"] = f"bytes={os.path.getsize(part)}-"
+            request_headers["If-Range"] = validator
+    elif saved_info is not None and os.path.isfile(dest):
+        saved_headers = parse_headers_info(saved_info)
+        if "ETag" in saved_headers: request_headers["If-None-Match"] = saved_headers["ETag"]
+        if "Last-Modified" in saved_headers: request_headers["If-Modified-Since"] = saved_headers["Last-Modified"]
+
+    with get_http_session().get(url, stream=True, headers=request_headers, timeout=HTTP_TIMEOUT) as response:
+        if response.status_code == 304:
+            logging.debug(f"{description} not modified: {url}")
+            return parse_headers_info(saved_info), False
+        #else
+        if response.status_code == 416 and "Range" in request_headers:
+            # the partial download is not a prefix of what the server has (any more); start over
+            logging.info(f"Cannot resume download of {url} at byte {os.path.getsize(part)}, downloading it again.")
+            os.remove(part)
+            os.remove(part_info_path)
+            return fetch_tarball(url, dest, saved_headers_path, description)
+        #else
+        response.raise_for_status()  # Raise an error for bad responses
+        headers = requests.structures.CaseInsensitiveDict(response.headers)
+        if response.status_code == 206:
+            total = headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit(): headers["Content-Length"] = total
+        elif saved_info == headers_to_info(headers) and os.path.isfile(dest):
+            # the server ignored the conditional request, but the content is the same
+            return headers, False
+        #else
+        logging.debug(f"{description} headers mismatch: saved={repr(saved_info)} current={repr(headers_to_info(headers))}")
+        if response.status_code != 206 and tarball_cache_fetch(url, headers, dest):
+            return headers, True
+        #else
+        if response.status_code == 206:
+            logging.info(f"Resuming download of {url} at byte {os.path.getsize(part)}")
+            mode = "ab"
+        else:
+            logging.info(f"{description} info has changed, downloading new tarball.")
+            with open(part_info_path, "w") as f:
+                f.write(headers_to_info(headers))
+            mode = "wb"
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    return finish_download(url, part, dest, headers), True
+
+def finish_download(url, part, dest, headers):
+    """Move a completed dest.part of fetch_tarball() into place and into the tarball cache."""
+    os.replace(part, dest)
+    os.remove(part + ".info")
     logging.info(f"Downloaded {url} to {dest}")
-    return response.headers
+    tarball_cache_store(url, headers, dest)
+    return headers
 
 def setup_lower_image(lower_image, stage3_tarball, portage_tarball, overlay_tarball):
     # create image file
     lower_size_in_gib = genpack_json.get("lower-layer-capacity", DEFAULT_LOWER_SIZE_IN_GIB)
-    logging.info(f"Creating image file at {lower_image} with size {lower_size_in_gib} GiB.")
-    with open(lower_image, "wb") as f:
-        f.seek(lower_size_in_gib * 1024 * 1024 * 1024 - 1)
-        f.write(b'\x00')
+    create_image(lower_image, lower_size_in_gib)
     try:
-        logging.info(f"Formatting filesystem on {lower_image}")
-        subprocess.run(['mkfs.ext4', '-O', '^has_journal', lower_image], check=True)
-        logging.info("Filesystem formatted successfully.")
         logging.info("Extracting stage3 to lower image...")
         subprocess.run(["genpack-helper", "stage3", lower_image, stage3_tarball], check=True)
         logging.info("Extracting portage to lower image...")
@@ -291,6 +1552,23 @@ echo -e '[genpack-overlay]\nlocation=/var/db/repos/genpack-overlay' > /etc/porta
         os.remove(lower_image)  # Clean up the image
         raise
 
+def branch_lower_image(base, variant):
+    """Make the variant's lower image a clone of the (fully built) base lower image, unless it
+    already is one of the current base. Returns True if the image was (re)cloned."""
+    stamp = str(os.stat(base.lower_done).st_mtime_ns)
+    if os.path.isfile(variant.lower_image) and os.path.isfile(variant.lower_base):
+        with open(variant.lower_base) as f:
+            if f.read().strip() == stamp: return False
+    #else
+    logging.info(f"Branching {variant.lower_image} from {base.lower_image}...")
+    copy_image(base.lower_image, variant.lower_image)
+    # the clone has been built in full already (no circular-dep breaker needed), but not for this variant
+    for marker in [variant.lower_done, variant.lower_fresh]:
+        if os.path.exists(marker): os.remove(marker)
+    with open(variant.lower_base, "w") as f:
+        f.write(stamp + "\n")
+    return True
+
 def replace_portage(lower_image, portage_tarball):
     logging.info(f"Replacing portage in lower image: {lower_image}")
     #portage_dir = os.path.join(mount_point, "var/db/repos/gentoo")
@@ -308,13 +1586,25 @@ def replace_overlay(lower_image, overlay_tarball):
         subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "tar", "xzf", "-", "-C", "/var/db/repos/genpack-overlay", "--strip-components=1"], stdin=f, text=False, check=True)
     logging.info("Genpack overlay replaced successfully.")
 
-def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packages, accept_keywords, use, license, mask, env):
+def distfiles_nspawn_opts():
+    """genpack-helper nspawn options for fetching sources: the shared distfiles dir and the Gentoo mirror."""
+    nspawn_opts = []
+    if not independent_distfiles:
+        os.makedirs(distfiles_dir, exist_ok=True)
+        nspawn_opts += [f"--distfiles-dir={distfiles_dir}", f"--setenv=DISTDIR={SHARED_DISTDIR}"]
+    if gentoo_mirrors is not None:
+        nspawn_opts.append(f"--setenv=GENTOO_MIRRORS={gentoo_mirrors}")
+    return nspawn_opts
+
+def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packages, accept_keywords, use, license, mask, env, generated_env=None):
+    """generated_env maps names of env files genpack generates itself to (content, atoms using it)."""
     if accept_keywords is None: accept_keywords = {}
     if use is None: use = {}
     if license is None: license = {}
     if mask is None: mask = []
     if buildtime_packages is None: buildtime_packages = []
     if env is None: env = {}
+    if generated_env is None: generated_env = {}
 
     files = {}
 
@@ -373,6 +1663,9 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
     if not isinstance(env, dict):
         raise ValueError("env must be a dictionary")
     env_content = ""
+    # generated entries come first so that the artifact's own env files override them
+    for name, (_, atoms) in generated_env.items():
+        env_content += "".join(f"{atom} {name}\n" for atom in atoms)
     for k, v in env.items():
         if v is None:
             env_content += f"{k}\n"
@@ -390,24 +1683,25 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
                 content = content.encode('utf-8')
             info.size = len(content)
             tar.addfile(tarinfo=info, fileobj=io.BytesIO(content))
-    
-    subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "tar", "xf", "-"], input=tar_buf.getvalue(), check=True, text=False)
+
+    # Everything below is applied by a single script in a single container session
+    # (the generated files arrive as a tar stream on stdin); starting a container per
+    # step used to dominate this phase.
+    script = ["set -e", "tar xf - -C /"]
 
     # apply savedconfig
     if os.path.isdir("savedconfig"):
         logging.info(f"Installing savedconfig...")
-        subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--delete", "/mnt/host/savedconfig", "/etc/portage"], check=True)
+        script.append("rsync -rlptD --delete /mnt/host/savedconfig /etc/portage")
     else:
-        script = """[ -d /etc/portage/savedconfig ] && echo "Removing existing savedconfig directory" && rm -rf /etc/portage/savedconfig || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("""[ -d /etc/portage/savedconfig ] && echo "Removing existing savedconfig directory" && rm -rf /etc/portage/savedconfig || true""")
 
     # apply patches
     if os.path.isdir("patches"):
         logging.info(f"Installing patches...")
-        subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--delete", "/mnt/host/patches", "/etc/portage"], check=True)
+        script.append("rsync -rlptD --delete /mnt/host/patches /etc/portage")
     else:
-        script = """[ -d /etc/portage/patches ] && echo "Removing existing patches directory" && rm -rf /etc/portage/patches || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("""[ -d /etc/portage/patches ] && echo "Removing existing patches directory" && rm -rf /etc/portage/patches || true""")
         
     # apply kernel config
     if os.path.isdir("kernel"):
@@ -423,7 +1717,7 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
         # second pass below; exclude them from this arch-agnostic first pass so
         # they don't leak into other arches (the /-anchored pattern matches only
         # the top-level arch-* entries of the transfer root).
-        subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--exclude=/arch-*", "/mnt/host/kernel/", "/etc/kernel"], check=True)
+        script.append("rsync -rlptD '--exclude=/arch-*' /mnt/host/kernel/ /etc/kernel")
         # Per-arch overlay: rsync kernel/arch-<arch>/ *on top* of /etc/kernel
         # (contents-merge, no --delete) so e.g. kernel/arch-riscv64/config.d/
         # zz-no-kcfi.config layers onto the shared config.d/. This lets one
@@ -443,39 +1737,42 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
         # still omitted: the overlay adds/overwrites, it must not wipe base files.)
         if os.path.isdir(f"kernel/arch-{arch}"):
             logging.info(f"Overlaying per-arch kernel config (arch-{arch})...")
-            subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--ignore-times", f"/mnt/host/kernel/arch-{arch}/", "/etc/kernel"], check=True)
+            script.append(f"rsync -rlptD --ignore-times /mnt/host/kernel/arch-{arch}/ /etc/kernel")
     else:
-        script = """[ -d /etc/kernel ] && echo "Removing existing kernel directory" && rm -rf /etc/kernel || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("""[ -d /etc/kernel ] && echo "Removing existing kernel directory" && rm -rf /etc/kernel || true""")
 
     # apply env
     if os.path.isdir("env"):
         logging.info(f"Installing env...")
-        subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--delete", "/mnt/host/env", "/etc/portage"], check=True)
+        script.append("rsync -rlptD --delete /mnt/host/env /etc/portage")
     else:
-        script = """[ -d /etc/portage/env ] && echo "Removing existing env directory" && rm -rf /etc/portage/env || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("""[ -d /etc/portage/env ] && echo "Removing existing env directory" && rm -rf /etc/portage/env || true""")
 
     # apply local overlay
     if os.path.isdir("overlay"):
         logging.info(f"Installing local overlay...")
-        subprocess.run(["genpack-helper", "nspawn", lower_image, 'rsync', '-rlptD', "--delete", "/mnt/host/overlay/", "/var/db/repos/genpack-local-overlay"], check=True)
-        script = """[ ! -f /etc/portage/repos.conf/genpack-local-overlay.conf ] && echo "Creating repos.conf for genpack-local-overlay" && mkdir -p /etc/portage/repos.conf && echo -e '[genpack-local-overlay]\nlocation=/var/db/repos/genpack-local-overlay' > /etc/portage/repos.conf/genpack-local-overlay.conf || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
-        script = """[ ! -f /var/db/repos/genpack-local-overlay/metadata/layout.conf ] && echo "Creating layout.conf for genpack-local-overlay" && mkdir -p /var/db/repos/genpack-local-overlay/metadata && echo -e 'masters = gentoo' > /var/db/repos/genpack-local-overlay/metadata/layout.conf || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
-        script = """[ ! -f /var/db/repos/genpack-local-overlay/profiles/repo_name ] && echo "Creating repo_name for local overlay" && mkdir -p /var/db/repos/genpack-local-overlay/profiles && echo 'genpack-local-overlay' > /var/db/repos/genpack-local-overlay/profiles/repo_name || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("rsync -rlptD --delete /mnt/host/overlay/ /var/db/repos/genpack-local-overlay")
+        script.append("""[ ! -f /etc/portage/repos.conf/genpack-local-overlay.conf ] && echo "Creating repos.conf for genpack-local-overlay" && mkdir -p /etc/portage/repos.conf && echo -e '[genpack-local-overlay]\nlocation=/var/db/repos/genpack-local-overlay' > /etc/portage/repos.conf/genpack-local-overlay.conf || true""")
+        script.append("""[ ! -f /var/db/repos/genpack-local-overlay/metadata/layout.conf ] && echo "Creating layout.conf for genpack-local-overlay" && mkdir -p /var/db/repos/genpack-local-overlay/metadata && echo -e 'masters = gentoo' > /var/db/repos/genpack-local-overlay/metadata/layout.conf || true""")
+        script.append("""[ ! -f /var/db/repos/genpack-local-overlay/profiles/repo_name ] && echo "Creating repo_name for local overlay" && mkdir -p /var/db/repos/genpack-local-overlay/profiles && echo 'genpack-local-overlay' > /var/db/repos/genpack-local-overlay/profiles/repo_name || true""")
+        # After the local overlay is set up (but before the expensive emerge), give artifacts
+        # a chance to regenerate Manifests for their local ebuilds. This runs inside the Lower
+        # container where /var/cache/distfiles is writable, allowing normal users to maintain
+        # proper DIST checksums without host-level distfiles write permission. The sources
+        # go to the shared distfiles dir, where the emerge finds them later.
+        manifest_script = _local_overlay_manifest_script()
+        if len(manifest_script) > 0 and not independent_distfiles:
+            script.append(f"install -d -o portage -g portage -m 2775 {SHARED_DISTDIR}")
+        script += manifest_script
     else:
-        script = """[ -f /etc/portage/repos.conf/genpack-local-overlay.conf ] && echo "Removing existing repos.conf for genpack-local-overlay" && rm -f /etc/portage/repos.conf/genpack-local-overlay.conf || true"""
-        subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"], input=script, text=True, check=True)
+        script.append("""[ -f /etc/portage/repos.conf/genpack-local-overlay.conf ] && echo "Removing existing repos.conf for genpack-local-overlay" && rm -f /etc/portage/repos.conf/genpack-local-overlay.conf || true""")
 
-    # After the local overlay is set up (but before the expensive emerge), give artifacts
-    # a chance to regenerate Manifests for their local ebuilds. This runs inside the Lower
-    # container where /var/cache/distfiles is writable, allowing normal users to maintain
-    # proper DIST checksums without host-level distfiles write permission.
-    if os.path.isdir("overlay"):
-        _maybe_regenerate_local_overlay_manifests(lower_image)
+    # generated env files are written last, the env/ handling above replaces /etc/portage/env as a whole
+    for name, (content, _) in generated_env.items():
+        script.append(f"mkdir -p /etc/portage/env && printf %s {shlex.quote(content)} > /etc/portage/env/{shlex.quote(name)}")
+
+    subprocess.run(["genpack-helper", "nspawn", "--console=pipe"] + distfiles_nspawn_opts() + [lower_image, "sh", "-c", "\n".join(script)],
+                   input=tar_buf.getvalue(), check=True, text=False)
 
 def set_profile(lower_image, profile_name):
     arch_map = {
@@ -704,49 +2001,69 @@ def create_work_root():
             raise
 
 def lower(variant=None, devel=False):
-    logging.info("Processing lower layer...")
     create_work_root()
     os.makedirs(work_dir, exist_ok=True)
+    branched = False
+    if variant.name is not None and genpack_json.get("share_lower", False):
+        # bring the common base lower image up to date first, then start from a clone of it so that
+        # only the variant's delta gets emerged. concurrent variant builds wait for each other here.
+        base = Variant(None)
+        with DirectoryLock(work_dir, mode="exclusive", lock_filename=".lower-base.lock"):
+            logging.info("Processing base lower layer shared by the variants...")
+            lower(base, devel)
+            branched = branch_lower_image(base, variant)
+    logging.info("Processing lower layer..." if variant.name is None else f"Processing lower layer of variant {variant.name}...")
     # todo: create .gitignore in work_root
-    stage3_is_new = False
-    stage3_url = get_latest_stage3_tarball_url()
-    logging.info(f"Latest stage3 tarball URL: {stage3_url}")
-    stage3_headers = get_headers(stage3_url)
     stage3_tarball = os.path.join(work_dir, "stage3.tar.xz")
     stage3_saved_headers_path = os.path.join(work_dir, "stage3.tar.xz.headers")
-    stage3_saved_headers = open(stage3_saved_headers_path).read().strip() if os.path.isfile(stage3_saved_headers_path) else None
-    if stage3_saved_headers != headers_to_info(stage3_headers):
-        logging.info("Stage3 tarball info has changed, downloading new tarball.")
-        stage3_headers = download(stage3_url, stage3_tarball)
-        stage3_is_new = True
-    
-    portage_is_new = False
-    portage_url = get_latest_portage_tarball_url()
-    logging.info(f"Latest portage tarball URL: {portage_url}")
-    portage_headers = get_headers(portage_url)
     portage_tarball = os.path.join(work_root, "portage.tar.xz") # because portage tarball is not architecture specific
     portage_saved_headers_path = os.path.join(work_root, "portage.tar.xz.headers")
-    portage_saved_headers = open(portage_saved_headers_path).read().strip() if os.path.isfile(portage_saved_headers_path) else None
-    if portage_saved_headers != headers_to_info(portage_headers):
-        logging.info("Portage tarball info has changed, downloading new tarball.")
-        portage_headers = download(portage_url, portage_tarball)
-        portage_is_new = True
-    
-    overlay_is_new = False
-    overlay_url = get_latest_overlay_tarball_url()
-    logging.info(f"Latest genpack overlay tarball URL: {overlay_url}")
-    overlay_headers = get_headers(overlay_url)
     overlay_tarball = os.path.join(work_root, "genpack-overlay.tar.gz")
     overlay_saved_headers_path = os.path.join(work_root, "genpack-overlay.tar.gz.headers")
-    overlay_saved_headers = open(overlay_saved_headers_path).read().strip() if os.path.isfile(overlay_saved_headers_path) else None
-    if overlay_saved_headers != headers_to_info(overlay_headers):
-        logging.debug(f"Overlay headers mismatch: saved={repr(overlay_saved_headers)} current={repr(headers_to_info(overlay_headers))}")
-        logging.info("Genpack overlay tarball info has changed, downloading new tarball.")
-        overlay_headers = download(overlay_url, overlay_tarball)
-        overlay_is_new = True
-
-    if stage3_is_new or not os.path.isfile(variant.lower_image):
-        setup_lower_image(variant.lower_image, stage3_tarball, portage_tarball, overlay_tarball)
+
+    pin = genpack_json.get("pin", {})
+    if not isinstance(pin, dict) or any(k not in ("stage3", "portage", "overlay") for k in pin):
+        raise ValueError("pin must be a dictionary with optional 'stage3', 'portage' and 'overlay' URLs")
+
+    def fetch(kind, get_latest_url, dest, saved_headers_path, description):
+        if offline:
+            reused = reuse_tarball(dest, saved_headers_path)
+            if reused is None:
+                raise FileNotFoundError(f"{description} {dest} is not available offline. Run 'genpack lower' once with network access first.")
+            #else
+            logging.info(f"Offline mode: using {dest} as is.")
+            return reused
+        #else
+        if kind in pin:
+            url = pin[kind]
+            reused = reuse_tarball(dest, saved_headers_path, url)
+            if reused is not None:
+                logging.info(f"{description} is pinned to {url}, skipping revalidation.")
+                return reused
+        else:
+            url = get_latest_url()
+        logging.info(f"{description} URL: {url}")
+        result = fetch_tarball(url, dest, saved_headers_path, description)
+        with open(dest + ".url", "w") as f:
+            f.write(url + "\n")
+        return result
+
+    # the three tarballs are independent of each other; check and download them concurrently.
+    # the tarballs under work/ are shared by the variants (and portage/overlay by the architectures)
+    # of a build matrix, so only one genpack process fetches at a time.
+    with build_report.step("fetch tarballs"), \
+            DirectoryLock(work_root, mode="exclusive", lock_filename=".fetch.lock"), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        stage3_future = executor.submit(fetch, "stage3", get_latest_stage3_tarball_url, stage3_tarball, stage3_saved_headers_path, "Stage3 tarball")
+        portage_future = executor.submit(fetch, "portage", get_latest_portage_tarball_url, portage_tarball, portage_saved_headers_path, "Portage tarball")
+        overlay_future = executor.submit(fetch, "overlay", get_latest_overlay_tarball_url, overlay_tarball, overlay_saved_headers_path, "Genpack overlay tarball")
+        stage3_headers, stage3_is_new = stage3_future.result()
+        portage_headers, portage_is_new = portage_future.result()
+        overlay_headers, overlay_is_new = overlay_future.result()
+
+    if (stage3_is_new and not branched) or not os.path.isfile(variant.lower_image):
+        with build_report.step("set up lower image", [variant.lower_image]):
+            setup_lower_image(variant.lower_image, stage3_tarball, portage_tarball, overlay_tarball)
         with open(stage3_saved_headers_path, 'w') as f:
             f.write(headers_to_info(stage3_headers))
         # the vardb is now the bare stage3 baseline; remember that a full build
@@ -755,9 +2072,11 @@ def lower(variant=None, devel=False):
         open(variant.lower_fresh, "w").close()
     else:
         if portage_is_new:
-            replace_portage(variant.lower_image, portage_tarball)
+            with build_report.step("replace portage", [variant.lower_image]):
+                replace_portage(variant.lower_image, portage_tarball)
         if overlay_is_new:
-            replace_overlay(variant.lower_image, overlay_tarball)
+            with build_report.step("replace genpack-overlay", [variant.lower_image]):
+                replace_overlay(variant.lower_image, overlay_tarball)
 
     if portage_is_new:
         with open(portage_saved_headers_path, 'w') as f:
@@ -771,30 +2090,54 @@ def lower(variant=None, devel=False):
         logging.info(f"Removing old {variant.lower_done} file due to changes in stage3, portage, or overlay.")
         os.remove(variant.lower_done)
 
-    if os.path.exists(variant.lower_done):
-        logging.info("Lower image is up-to-date, skipping.")
-        return
-
     # merge main genpack.json
     merged_genpack_json = {}
     merge_genpack_json(merged_genpack_json, genpack_json, ["genpack.json"],
         ["profile","packages","buildtime_packages","buildtime_packages_first",
             "accept_keywords","use","mask","license","env","binpkg_excludes",
             "arch","variants"], variant)
+    # everything in genpack.json that affects the lower image
+    lower_config = dict(merged_genpack_json, profile=genpack_json.get("profile", None),
+                        circulardep_breaker=genpack_json.get("circulardep_breaker", None))
 
-    profile = genpack_json.get("profile", None)
-    set_profile(variant.lower_image, profile)
+    # the inputs are captured before applying them; edits made during the build must trigger the next one
+    lower_inputs, plan = plan_lower_update(variant, lower_config)
+    if plan is None:
+        logging.info("Lower image is up-to-date, skipping.")
+        return
+    #else
+    # an interrupted update must not leave the image looking complete
+    if os.path.exists(variant.lower_done):
+        os.remove(variant.lower_done)
+
+    parallel_plan = None
+    generated_env = {}  # package.env files genpack writes itself, see apply_portage_sets_and_flags()
+    if parallel:
+        parallel_config = genpack_json.get("parallel", {})
+        parallel_plan = plan_parallelism(parallel_config if isinstance(parallel_config, dict) else {})
+
+    tmpfs_fallback_dir = "/var/tmp/genpack-disk"
+    if portage_tmpfs is not None:
+        tmpfs_config = genpack_json.get("portage_tmpfs", {})
+        excluded = tmpfs_config.get("exclude", DEFAULT_TMPFS_EXCLUDED_PACKAGES) if isinstance(tmpfs_config, dict) else DEFAULT_TMPFS_EXCLUDED_PACKAGES
+        if len(excluded) > 0:
+            # portage builds in $PORTAGE_TMPDIR/portage, which is then on the image's disk
+            generated_env["genpack-tmpfs-fallback.conf"] = (f'PORTAGE_TMPDIR="{tmpfs_fallback_dir}"\n', excluded)
 
+    profile = genpack_json.get("profile", None)
     #devel = devel or merged_genpack_json.get("devel", False)
 
-    apply_portage_sets_and_flags(variant.lower_image, 
-                                merged_genpack_json.get("packages", []),
-                                merged_genpack_json.get("buildtime_packages", []),
-                                merged_genpack_json.get("accept_keywords", {}),
-                                merged_genpack_json.get("use", {}), 
-                                merged_genpack_json.get("license", {}), 
-                                merged_genpack_json.get("mask", []),
-                                merged_genpack_json.get("env", {}))
+    with build_report.step("apply portage configuration", [variant.lower_image]):
+        set_profile(variant.lower_image, profile)
+        apply_portage_sets_and_flags(variant.lower_image,
+                                    merged_genpack_json.get("packages", []),
+                                    merged_genpack_json.get("buildtime_packages", []),
+                                    merged_genpack_json.get("accept_keywords", {}),
+                                    merged_genpack_json.get("use", {}), 
+                                    merged_genpack_json.get("license", {}), 
+                                    merged_genpack_json.get("mask", []),
+                                    merged_genpack_json.get("env", {}),
+                                    generated_env)
 
     # binpkg_excludes
     binpkg_excludes = merged_genpack_json.get("binpkg_excludes", [])
@@ -809,123 +2152,257 @@ def lower(variant=None, devel=False):
         nspawn_opts.append(f"--binpkgs-dir={binpkgs_dir}")
     if overlay_override is not None:
         nspawn_opts.append(f"--genpack-overlay-dir={overlay_override}")
+    features = []
     if is_emulated_build():
         # qemu-user cannot create its internal threads inside the PID namespace
         # portage's pid-sandbox sets up for each ebuild phase (Gentoo bug #703278)
-        nspawn_opts.append("--setenv=FEATURES=-pid-sandbox")
+        features.append("-pid-sandbox")
+    if ccache_size is not None:
+        os.makedirs(ccache_dir, exist_ok=True)
+        features.append("ccache")
+        # a subdirectory owned by portage (created below); group-writable so that the ccache
+        # commands genpack runs as root and the compilations portage runs as its user can share it
+        nspawn_opts += [f"--ccache-dir={ccache_dir}", f"--setenv=CCACHE_DIR={CCACHE_DIR}",
+                        f"--setenv=CCACHE_MAXSIZE={ccache_size}", "--setenv=CCACHE_UMASK=002"]
+    if len(features) > 0:
+        nspawn_opts.append(f"--setenv=FEATURES={' '.join(features)}")
+
+    nspawn_opts += distfiles_nspawn_opts()
+
+    if portage_tmpfs is not None:
+        logging.info(f"Building in a {portage_tmpfs} tmpfs at /var/tmp/portage.")
+        nspawn_opts.append(f"--portage-tmpfs={portage_tmpfs}")
 
     emerge_parallel_opts = []
-    if parallel:
-        nproc = os.cpu_count() or 1
-        emerge_parallel_opts = [f"--jobs={nproc}", f"--load-average={nproc}"]
-
-    # circular dependency breaker
-    if "circulardep-breaker" in genpack_json:
-        raise ValueError("Use circulardep_breaker instead of circulardep-breaker in genpack.json")
-    if "circulardep_breaker" in genpack_json:
-        circulardep_breaker_packages = genpack_json["circulardep_breaker"].get("packages", [])
-        circulardep_breaker_use = genpack_json["circulardep_breaker"].get("use", None)
-        if len(circulardep_breaker_packages) > 0:
-            logging.info("Emerging circular dependency breaker packages...")
-            circulardep_breaker_nspawn_opts = nspawn_opts.copy()
-            if circulardep_breaker_use:
-                logging.info(f"Setting circulardep_breaker USE flags to: {circulardep_breaker_use}")
-                circulardep_breaker_nspawn_opts.append(f"--setenv=USE={circulardep_breaker_use}")
-            else:
-                logging.warning("circulardep_breaker use is not set, proceeding without setting USE flags.")
-            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-u", "--keep-going"] + emerge_parallel_opts
+    if parallel_plan is not None:
+        emerge_parallel_opts = [f"--jobs={parallel_plan['jobs']}", f"--load-average={parallel_plan['load_average']}"]
+        nspawn_opts.append(f"--setenv=MAKEOPTS=-j{parallel_plan['make_jobs']} -l{parallel_plan['load_average']}")
+
+    # other genpack processes may share binpkgs_dir: emerge under a shared lock so that nobody
+    # cleans it meanwhile, and take the lock exclusively for eclean-pkg below
+    binpkgs_lock = contextlib.nullcontext() if independent_binpkgs else DirectoryLock(binpkgs_dir, mode="shared")
+
+    lower_binhost = None
+    if binhost is not None:
+        if independent_binpkgs:
+            logging.warning("A binhost cannot be used with independent binpkgs (they live inside the lower image), ignoring it.")
+        else:
+            lower_binhost = binhost_url(binhost, profile, merged_genpack_json.get("use", {}))
+    build_start = int(time.time())
+
+    # what the image consisted of before this build, to tell why packages get built from source
+    previous_packages = load_installed_packages(variant.lower_packages)
+    emerge_log_file = os.path.join(work_dir, f"emerge-log-{os.getpid()}")
+
+    # the compiler cache is shared the same way; ccache itself copes with concurrent compilations
+    ccache_lock = contextlib.nullcontext() if ccache_size is None else DirectoryLock(ccache_dir, mode="shared")
+
+    with binpkgs_lock, ccache_lock, nspawn_container(variant.lower_image, nspawn_opts) as container:
+        if ccache_size is not None:
+            # portage refuses FEATURES=ccache without it; depclean removes it again at the end,
+            # so the stats are read before that
+            container.run(["install", "-d", "-o", "portage", "-g", "portage", "-m", "2775", CCACHE_DIR])
+            logging.info("Installing ccache...")
+            container.run('FEATURES="$FEATURES -ccache" emerge -1n -bk --binpkg-respect-use=y dev-util/ccache')
+            ccache_stats_file = os.path.join(work_dir, f"ccache-stats-{os.getpid()}")
+            ccache_stats = read_ccache_stats(container, ccache_stats_file)
+        if portage_tmpfs is not None:
+            container.run(["install", "-d", "-o", "portage", "-g", "portage", "-m", "0775", tmpfs_fallback_dir])
+        if not independent_distfiles:
+            container.run(["install", "-d", "-o", "portage", "-g", "portage", "-m", "2775", SHARED_DISTDIR])
+        container.run(emerge_log_size_cmd(emerge_log_file))
+        with open(emerge_log_file) as f:
+            emerge_log_offset = int(f.read().strip() or "0")
+        if lower_binhost is not None and not offline and pull_binpkgs(lower_binhost) > 0:
+            container.run(["emaint", "binhost", "--fix"])
+        if plan == "full":
+            # download the sources of everything that will be built from source up front, several at a
+            # time, so that the compilation below does not wait for the network
+            if not offline:
+                logging.info("Prefetching distfiles...")
+                prefetch_cmd = ["emerge", "--fetchonly", f"--jobs={PREFETCH_JOBS}", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"]
+                if len(binpkg_excludes) > 0:
+                    prefetch_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                prefetch_cmd += ["@world", "@genpack-runtime", "@genpack-buildtime"]
+                if container.run(prefetch_cmd, check=False) != 0:
+                    logging.warning("Prefetching some distfiles failed; the build will retry fetching them.")
+
+            # circular dependency breaker
+            if "circulardep-breaker" in genpack_json:
+                raise ValueError("Use circulardep_breaker instead of circulardep-breaker in genpack.json")
+            if "circulardep_breaker" in genpack_json:
+                circulardep_breaker_packages = genpack_json["circulardep_breaker"].get("packages", [])
+                circulardep_breaker_use = genpack_json["circulardep_breaker"].get("use", None)
+                if len(circulardep_breaker_packages) > 0:
+                    logging.info("Emerging circular dependency breaker packages...")
+                    circulardep_breaker_env = {}
+                    if circulardep_breaker_use:
+                        logging.info(f"Setting circulardep_breaker USE flags to: {circulardep_breaker_use}")
+                        circulardep_breaker_env["USE"] = circulardep_breaker_use
+                    else:
+                        logging.warning("circulardep_breaker use is not set, proceeding without setting USE flags.")
+                    emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-u", "--keep-going"] + emerge_parallel_opts
+                    if len(binpkg_excludes) > 0:
+                        emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                        emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+                    emerge_cmd += circulardep_breaker_packages
+                    logging.debug(f"Circulardep breaker emerge command: {' '.join(emerge_cmd)}")
+                    container.run(emerge_cmd, env=circulardep_breaker_env)
+
+            # automatic circular dependency breaker. only needed when packages get
+            # compiled from source (warm binpkgs let emerge install in any order,
+            # ignoring build-time dependency cycles), i.e. on a freshly extracted lower
+            # image. lower.fresh marks that state and persists across failed retries.
+            # --break-circular-deps forces it for the rare case where a USE change on an
+            # already-built image introduces a new cycle.
+            if os.path.exists(variant.lower_fresh) or break_circular_deps:
+                # genpack-progs is installed with --nodeps because its full dependency
+                # closure is resolved by the main emerge right after (it is part of
+                # @system via the profile)
+                logging.info("Checking for circular dependencies...")
+                container.run(["emerge", "--oneshot", "--update", "--nodeps", "-bk", "--binpkg-respect-use=y",
+                                "genpack/genpack-progs"])
+                breaker_available = container.run("which genpack-break-circular-dep >/dev/null 2>&1", check=False) == 0
+                if breaker_available:
+                    container.run(["genpack-break-circular-dep"] + emerge_parallel_opts)
+                else:
+                    logging.warning("genpack-break-circular-dep not available (genpack-progs too old?), skipping automatic circular dependency check.")
+
+            # Opt-in: emerge @genpack-buildtime in its own pass *before* the main emerge.
+            # buildtime_packages normally just means "in the Lower, kept out of the final
+            # image"; portage merges them together with runtime packages and resolves order
+            # via declared dependencies. But a build-env tool that a runtime package needs
+            # *without* a declared dependency (e.g. a clang/LLVM toolchain imposed on
+            # gentoo-kernel via package.env) has no dependency edge, so portage cannot
+            # guarantee it is built first — and under --parallel they race. This flag lets
+            # such artifacts opt in to seeding buildtime_packages into the build environment
+            # first (a separate emerge process, so PATH/profile.env are also refreshed for
+            # the main pass). See ADR-0003.
+            if merged_genpack_json.get("buildtime_packages_first", False) \
+                    and len(merged_genpack_json.get("buildtime_packages", [])) > 0:
+                logging.info("Emerging buildtime_packages first (buildtime_packages_first=true)...")
+                emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"] + emerge_parallel_opts
+                if len(binpkg_excludes) > 0:
+                    emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                    emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+                emerge_cmd += ["@genpack-buildtime"]
+                container.run(emerge_cmd)
+
+            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"]
             if len(binpkg_excludes) > 0:
                 emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
                 emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-            emerge_cmd += circulardep_breaker_packages
-            logging.debug(f"Circulardep breaker emerge command: {' '.join(emerge_cmd)}")
-            subprocess.run(["genpack-helper", "nspawn"] + circulardep_breaker_nspawn_opts + [variant.lower_image] + emerge_cmd, check=True)
-
-    # automatic circular dependency breaker. only needed when packages get
-    # compiled from source (warm binpkgs let emerge install in any order,
-    # ignoring build-time dependency cycles), i.e. on a freshly extracted lower
-    # image. lower.fresh marks that state and persists across failed retries.
-    # --break-circular-deps forces it for the rare case where a USE change on an
-    # already-built image introduces a new cycle.
-    if os.path.exists(variant.lower_fresh) or break_circular_deps:
-        # genpack-progs is installed with --nodeps because its full dependency
-        # closure is resolved by the main emerge right after (it is part of
-        # @system via the profile)
-        logging.info("Checking for circular dependencies...")
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image,
-                        "emerge", "--oneshot", "--update", "--nodeps", "-bk", "--binpkg-respect-use=y",
-                        "genpack/genpack-progs"], check=True)
-        breaker_available = subprocess.run(["genpack-helper", "nspawn", "--console=pipe"] + nspawn_opts
-                        + [variant.lower_image, "which", "genpack-break-circular-dep"],
-                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
-        if breaker_available:
-            subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image,
-                            "genpack-break-circular-dep"] + emerge_parallel_opts, check=True)
-        else:
-            logging.warning("genpack-break-circular-dep not available (genpack-progs too old?), skipping automatic circular dependency check.")
-
-    # Opt-in: emerge @genpack-buildtime in its own pass *before* the main emerge.
-    # buildtime_packages normally just means "in the Lower, kept out of the final
-    # image"; portage merges them together with runtime packages and resolves order
-    # via declared dependencies. But a build-env tool that a runtime package needs
-    # *without* a declared dependency (e.g. a clang/LLVM toolchain imposed on
-    # gentoo-kernel via package.env) has no dependency edge, so portage cannot
-    # guarantee it is built first — and under --parallel they race. This flag lets
-    # such artifacts opt in to seeding buildtime_packages into the build environment
-    # first (a separate emerge process, so PATH/profile.env are also refreshed for
-    # the main pass). See ADR-0003.
-    if merged_genpack_json.get("buildtime_packages_first", False) \
-            and len(merged_genpack_json.get("buildtime_packages", [])) > 0:
-        logging.info("Emerging buildtime_packages first (buildtime_packages_first=true)...")
-        emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"] + emerge_parallel_opts
-        if len(binpkg_excludes) > 0:
-            emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
-            emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-        emerge_cmd += ["@genpack-buildtime"]
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + emerge_cmd, check=True)
-
-    logging.info("Emerging all packages...")
-    emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"] + emerge_parallel_opts
-    if len(binpkg_excludes) > 0:
-        emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
-        emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-    emerge_cmd += ["@world", "@genpack-runtime", "@genpack-buildtime"]
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + emerge_cmd, check=True)
-    logging.info("Rebuilding kernel modules if necessary...")
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image, "rebuild-kernel-modules-if-necessary"], check=True)
-
-    logging.info("Rebuilding preserved packages...")
-    emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y"] + emerge_parallel_opts
-    if len(binpkg_excludes) > 0:
-        emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
-        emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-    emerge_cmd += ["@preserved-rebuild"]
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + emerge_cmd, check=True)
-
-    logging.info("Unmerging masked packages...")
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image, "genpack-unmerge-masked-packages"] + emerge_parallel_opts, check=True)
-
-    logging.info("Cleaning up...")
-    # Run depclean on its own so we can fall back to --with-bdeps=n on failure.
-    # The default depclean (--with-bdeps=y) keeps build-time dependencies and, as
-    # a safety measure, aborts entirely when they can't all be resolved (e.g. mid
-    # python-target migration). In the lower layer only the runtime/buildtime
-    # package sets and their runtime closure need to survive, so dropping build
-    # deps is a safe fallback that also slims the layer.
-    depclean_cmd = ["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image, "emerge", "--depclean"]
-    if deep_depclean:
-        subprocess.run(depclean_cmd + ["--with-bdeps=n"], check=True)
-    elif subprocess.run(depclean_cmd).returncode != 0:
-        logging.warning("emerge --depclean failed; retrying with --with-bdeps=n")
-        subprocess.run(depclean_cmd + ["--with-bdeps=n"], check=True)
-
-    cleanup_cmd = "etc-update --automode -5"
-    cleanup_cmd += " && eclean-dist -d"
-    cleanup_cmd += " && eclean-pkg"
-    if independent_binpkgs:
-        cleanup_cmd += " -d" # with independent binpkgs, we can clean up binpkgs more aggressively
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image, "sh", "-c", cleanup_cmd], check=True)
+            targets = ["@world", "@genpack-runtime", "@genpack-buildtime"]
+            if parallel_plan is not None:
+                emerge_heavy_packages(container, emerge_cmd, targets, parallel_plan)
+            logging.info("Emerging all packages...")
+            container.run(emerge_cmd + emerge_parallel_opts + targets)
+            logging.info("Rebuilding kernel modules if necessary...")
+            container.run(["rebuild-kernel-modules-if-necessary"])
+
+            logging.info("Rebuilding preserved packages...")
+            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y"] + emerge_parallel_opts
+            if len(binpkg_excludes) > 0:
+                emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+            emerge_cmd += ["@preserved-rebuild"]
+            container.run(emerge_cmd)
+
+            logging.info("Unmerging masked packages...")
+            container.run(["genpack-unmerge-masked-packages"] + emerge_parallel_opts)
 
+        else:
+            rebuild = plan["rebuild"] + (DIST_KERNEL_PACKAGES if plan["kernel"] else [])
+            if len(rebuild) > 0:
+                logging.info(f"Re-emerging packages affected by changed inputs: {' '.join(rebuild)}")
+                # from source (the existing binpkgs were built without the change), and only
+                # those actually installed; heavy ones first, one at a time (see emerge_heavy_packages())
+                emerge_cmd = ["emerge", "--oneshot", "--usepkg=n", "-b"]
+                if len(binpkg_excludes) > 0:
+                    emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+                heavy = set() if parallel_plan is None else set(package_key(atom) for atom in parallel_plan["heavy_packages"])
+                passes = [([atom for atom in rebuild if package_key(atom) in heavy], ["--jobs=1"],
+                           None if parallel_plan is None else {"MAKEOPTS": f"-j{parallel_plan['heavy_make_jobs']} -l{parallel_plan['load_average']}"}),
+                          ([atom for atom in rebuild if package_key(atom) not in heavy], emerge_parallel_opts, None)]
+                for atoms, opts, env in passes:
+                    if len(atoms) == 0: continue
+                    #else
+                    container.run("set --\n"
+                        + f"for atom in {shlex.join(atoms)}; do\n"
+                        + '    [ -n "$(portageq match / "$atom")" ] && set -- "$@" "$atom"\n'
+                        + "done\n"
+                        + f'[ $# -eq 0 ] || {shlex.join(emerge_cmd + opts)} "$@"', env=env)
+            if plan["kernel"]:
+                logging.info("Rebuilding kernel modules if necessary...")
+                container.run(["rebuild-kernel-modules-if-necessary"])
+            if len(rebuild) > 0:
+                logging.info("Rebuilding preserved packages...")
+                emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y"] + emerge_parallel_opts
+                if len(binpkg_excludes) > 0:
+                    emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                    emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+                emerge_cmd += ["@preserved-rebuild"]
+                container.run(emerge_cmd)
+            if plan["mask"]:
+                logging.info("Unmerging masked packages...")
+                container.run(["genpack-unmerge-masked-packages"] + emerge_parallel_opts)
+
+        container.run(emerge_log_tail_cmd(emerge_log_offset, emerge_log_file))
+        with open(emerge_log_file, errors="replace") as f:
+            merges = emerge_report(parse_emerge_log(f.read()), previous_packages, plan)
+        os.remove(emerge_log_file)
+        with open(variant.emerge_report, "w") as f:
+            json.dump({"time": time.time(), "plan": plan, "merges": merges}, f, indent=1)
+        log_emerge_report(merges)
+        update_emerge_history(merges, genpack_json["name"])
+
+        if ccache_size is not None:
+            report_ccache_stats(ccache_stats, read_ccache_stats(container, ccache_stats_file))
+            # concurrent builds may have overshot the limit between ccache's own cleanups. Nothing
+            # compiles from here on, so the shared lock is dropped for good before waiting for the
+            # exclusive one: waiting while holding it would deadlock with another build doing the
+            # same, and so would holding it while taking the binpkgs lock exclusively below.
+            ccache_lock.release()
+            with DirectoryLock(ccache_dir, mode="exclusive"):
+                container.run(["ccache", "--cleanup"])
+
+        logging.info("Cleaning up...")
+        # Run depclean on its own so we can fall back to --with-bdeps=n on failure.
+        # The default depclean (--with-bdeps=y) keeps build-time dependencies and, as
+        # a safety measure, aborts entirely when they can't all be resolved (e.g. mid
+        # python-target migration). In the lower layer only the runtime/buildtime
+        # package sets and their runtime closure need to survive, so dropping build
+        # deps is a safe fallback that also slims the layer.
+        # A partial update only removes packages when masks changed.
+        if plan == "full" or plan["mask"]:
+            depclean_cmd = ["emerge", "--depclean"]
+            if deep_depclean:
+                container.run(depclean_cmd + ["--with-bdeps=n"])
+            elif container.run(depclean_cmd, check=False) != 0:
+                logging.warning("emerge --depclean failed; retrying with --with-bdeps=n")
+                container.run(depclean_cmd + ["--with-bdeps=n"])
+
+        # shared distfiles are used by other projects as well; only clean the image's own
+        container.run("etc-update --automode -5" + (" && eclean-dist -d" if independent_distfiles else ""))
+        if independent_binpkgs:
+            container.run(["eclean-pkg", "-d"]) # with independent binpkgs, we can clean up binpkgs more aggressively
+        else:
+            binpkgs_lock.convert("exclusive")
+            container.run(["eclean-pkg"])
+            binpkgs_lock.convert("shared")
+            if lower_binhost is not None and binhost_push and not offline:
+                push_binpkgs(lower_binhost, build_start)
+
+        # keep a copy of the world file so that changes made later via 'genpack bash' can be
+        # detected without starting a container
+        container.run(copy_world_cmd(variant.lower_world))
+        container.run(installed_packages_cmd(variant.lower_packages))
+        if not independent_binpkgs:
+            record_binpkg_usage(variant)
+
+    save_lower_record(variant, lower_inputs, lower_config)
+    if os.path.exists(variant.lower_world + ".current"):
+        os.remove(variant.lower_world + ".current")
     with open(variant.lower_done, "w") as f:
         f.write("lower build complete\n")
     # a full build succeeded; the image is no longer in the fresh state, so the
@@ -934,8 +2411,8 @@ def lower(variant=None, devel=False):
         os.remove(variant.lower_fresh)
 
 
-def _maybe_regenerate_local_overlay_manifests(lower_image):
-    """Regenerate Manifests for local overlay ebuilds inside the Lower container.
+def _local_overlay_manifest_script():
+    """Shell lines regenerating Manifests for local overlay ebuilds inside the Lower container.
 
     Simple policy:
     - If a package directory under the host's `overlay/` contains .ebuild files
@@ -950,7 +2427,7 @@ def _maybe_regenerate_local_overlay_manifests(lower_image):
     Manifest files for your local overlay packages.
     """
     if not os.path.isdir("overlay"):
-        return
+        return []
 
     packages_to_update = []
 
@@ -978,12 +2455,12 @@ def _maybe_regenerate_local_overlay_manifests(lower_image):
                 packages_to_update.append(f"{category}/{package}")
 
     if not packages_to_update:
-        return
+        return []
 
     logging.info(f"Regenerating Manifests for local overlay: {packages_to_update}")
 
-    # Build a small fixed shell script to run inside the container.
-    script_lines = ["#!/bin/sh", "set -e"]
+    # Run in a subshell so that a failing manifest doesn't fail the whole lower build.
+    script_lines = ["("]
     for p in packages_to_update:
         # Find one ebuild in the package (any version is fine for manifest regeneration)
         script_lines.append(
@@ -996,53 +2473,96 @@ def _maybe_regenerate_local_overlay_manifests(lower_image):
             '    ebuild "$ebuild_file" manifest || true'
         )
         script_lines.append('fi')
+    script_lines.append(') || echo "Warning: manifest regeneration for local overlay failed"')
 
-    script = "\n".join(script_lines) + "\n"
+    return script_lines
 
-    # Execute the script inside the Lower container (as root, with proper Portage env)
-    subprocess.run(
-        ["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh"],
-        input=script,
-        text=True,
-        check=False,   # don't fail the whole lower build if one manifest fails
-    )
 
+def copy_world_cmd(dest):
+    """Shell command copying the world file of the lower image to dest (relative to the current directory)."""
+    dest = shlex.quote(f"/mnt/host/{dest}")
+    return f"if [ -f /var/lib/portage/world ]; then cp /var/lib/portage/world {dest}; else : > {dest}; fi"
 
 def bash(variant, command=None):
     nspawn_opts = []
     if not independent_binpkgs:
         os.makedirs(binpkgs_dir, exist_ok=True)
         nspawn_opts.append("--binpkgs-dir=" + binpkgs_dir)
+    nspawn_opts += distfiles_nspawn_opts()
     if overlay_override is not None:
         nspawn_opts.append(f"--genpack-overlay-dir={overlay_override}")
+    # whatever happens in the container may change the world file (e.g. 'genpack bash emerge foo');
+    # leave a copy next to the one recorded at lower.done so the next build can tell
+    wrapper = ["sh", "-c", '"$@"; rc=$?; ' + copy_world_cmd(variant.lower_world + ".current") + '; exit $rc', "sh"]
     if command:
-        logging.info("Running command in the lower image.")
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + command, check=True)
+        # the command may emerge with the shared binpkgs; keep concurrent builds from cleaning them meanwhile
+        with contextlib.nullcontext() if independent_binpkgs else DirectoryLock(binpkgs_dir, mode="shared"):
+            logging.info("Running command in the lower image.")
+            subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + wrapper + command, check=True)
     else:
+        # no lock for an interactive shell: it may stay open indefinitely, and concurrent builds
+        # (and 'genpack gc' behind them) would wait for it to close before cleaning binpkgs
         logging.info("Running bash in the lower image for debugging.")
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image, "bash"])
-
-def upper(variant):
+        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [variant.lower_image] + wrapper + ["bash"])
+
+def groupadd_command(group):
+    """Validate a 'groups' entry of genpack.json and return the groupadd command line for it."""
+    name = group if isinstance(group, str) else None
+    gid = None
+    if name is None:
+        if not isinstance(group, dict): raise Exception("group must be string or dict")
+        #else
+        if "name" not in group: raise Exception("group dict must have 'name' key")
+        #else
+        name = group["name"]
+        if "gid" in group: gid = group["gid"]
+    groupadd_cmd = ["groupadd"]
+    if gid is not None: groupadd_cmd += ["-g", str(gid)]
+    groupadd_cmd.append(name)
+    return groupadd_cmd
+
+def useradd_command(user):
+    """Validate a 'users' entry of genpack.json and return the useradd command line for it."""
+    name = user if isinstance(user, str) else None
+    if name is None:
+        if not isinstance(user, dict): raise Exception("user must be string or dict")
+        #else
+        if "name" not in user: raise Exception("user dict must have 'name' key")
+        #else
+        name = user["name"]
+    else:
+        user = {}
+    uid = user.get("uid", None)
+    comment = user.get("comment", None)
+    home = user.get("home", None)
+    create_home = user.get("create_home", user.get("create-home", True))
+    shell = user.get("shell", None)
+    initial_group = user.get("initial_group", user.get("initial-group", None))
+    additional_groups = user.get("additional_groups", user.get("additional-groups", []))
+    if isinstance(additional_groups, str):
+        additional_groups = [additional_groups]
+    elif not isinstance(additional_groups, list):
+        raise Exception("additional-groups must be list or string")
+    empty_password = user.get("empty_password", user.get("empty-password", False))
+    useradd_cmd = ["useradd"]
+    if uid is not None: useradd_cmd += ["-u", str(uid)]
+    if comment is not None: useradd_cmd += ["-c", comment]
+    if home is not None: useradd_cmd += ["-d", home]
+    if initial_group is not None: useradd_cmd += ["-g", initial_group]
+    if len(additional_groups) > 0:
+        useradd_cmd += ["-G", ",".join(additional_groups)]
+    if shell is not None: useradd_cmd += ["-s", shell]
+    if create_home: useradd_cmd += ["-m"]
+    if empty_password: useradd_cmd += ["-p", ""]
+    useradd_cmd.append(name)
+    return useradd_cmd
+
+def upper(variant, incremental=False):
     logging.info("Processing upper layer...")
     if not os.path.isfile(variant.lower_image) or not os.path.exists(variant.lower_done):
         raise FileNotFoundError(f"Lower image {variant.lower_image} or lower completion marker {variant.lower_done} does not exist. Please run 'genpack lower' first.")
 
-    # always recreate upper image fresh
-    if os.path.isfile(variant.upper_image):
-        logging.info(f"Removing existing upper image {variant.upper_image} for fresh rebuild.")
-        os.remove(variant.upper_image)
-    with open(variant.upper_image, "wb") as f:
-        f.seek(DEFAULT_UPPER_SIZE_IN_GIB * 1024 * 1024 * 1024 - 1)
-        f.write(b'\x00')
-    try:
-        logging.info(f"Formatting filesystem on {variant.upper_image}")
-        subprocess.run(['mkfs.ext4', '-O', '^has_journal', variant.upper_image], check=True)
-        logging.info("Filesystem formatted successfully.")
-    except:
-        logging.error(f"Failed to format filesystem on {variant.upper_image}.")
-        os.remove(variant.upper_image)
-        raise
-
+    upper_size_in_gib = genpack_json.get("upper-layer-capacity", DEFAULT_UPPER_SIZE_IN_GIB)
     os.makedirs(download_dir, exist_ok=True)
     nspawn_opts = []
     if overlay_override is not None:
@@ -1052,22 +2572,15 @@ def upper(variant):
         # which hits the same pid-sandbox limitation as the lower phase (Gentoo bug #703278)
         nspawn_opts.append("--setenv=FEATURES=-pid-sandbox")
 
-    # build env opts shared across nspawn calls
-    env_opts = ["-E", f"ARTIFACT={genpack_json['name']}"]
+    nspawn_opts += [f"--download-dir={download_dir}", f"--overlay-image={variant.upper_image}:upper"]
+
+    # build env shared across artifact-facing commands
+    artifact_env = {"ARTIFACT": genpack_json['name']}
     profile = genpack_json.get("profile", None)
     if profile:
-        env_opts += ["-E", f"PROFILE={profile}"]
+        artifact_env["PROFILE"] = profile
     if variant.name is not None:
-        env_opts += ["-E", f"VARIANT={variant.name}"]
-
-    # 1. execute package scripts and generate /.genpack/ metadata (must run before artifact scripts)
-    logging.info("Executing package scripts and generating metadata...")
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [
-                    f"--download-dir={download_dir}",
-                    f"--overlay-image={variant.upper_image}:upper",
-                    *env_opts,
-                    variant.lower_image, "genpack-exec-package-scripts"],
-                    check=True)
+        artifact_env["VARIANT"] = variant.name
 
     # merge genpack.json for groups/users/services
     merged_genpack_json = {}
@@ -1075,111 +2588,118 @@ def upper(variant):
         "users","groups", "services", "arch", "variants"
     ], variant)
 
-    # 2. create groups
+    # groups first, so that users can refer to them
     groups = merged_genpack_json.get("groups", [])
-    for group in groups:
-        name = group if isinstance(group, str) else None
-        gid = None
-        if name is None:
-            if not isinstance(group, dict): raise Exception("group must be string or dict")
-            #else
-            if "name" not in group: raise Exception("group dict must have 'name' key")
-            #else
-            name = group["name"]
-            if "gid" in group: gid = group["gid"]
-        groupadd_cmd = ["groupadd"]
-        if gid is not None: groupadd_cmd += ["-g", str(gid)]
-        groupadd_cmd.append(name)
-        logging.info("Creating group %s..." % name)
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [f"--overlay-image={variant.upper_image}:upper", variant.lower_image] + groupadd_cmd, check=True)
-
-    # 3. create users
     users = merged_genpack_json.get("users", [])
-    for user in users:
-        name = user if isinstance(user, str) else None
-        if name is None:
-            if not isinstance(user, dict): raise Exception("user must be string or dict")
-            #else
-            if "name" not in user: raise Exception("user dict must have 'name' key")
-            #else
-            name = user["name"]
-        uid = user.get("uid", None)
-        comment = user.get("comment", None)
-        home = user.get("home", None)
-        create_home = user.get("create_home", user.get("create-home", True))
-        shell = user.get("shell", None)
-        initial_group = user.get("initial_group", user.get("initial-group", None))
-        additional_groups = user.get("additional_groups", user.get("additional-groups", []))
-        if isinstance(additional_groups, str):
-            additional_groups = [additional_groups]
-        elif not isinstance(additional_groups, list):
-            raise Exception("additional-groups must be list or string")
-        if "shell" in user: shell = user["shell"]
-        empty_password = user.get("empty_password", user.get("empty-password", False))
-        useradd_cmd = ["useradd"]
-        if uid is not None: useradd_cmd += ["-u", str(uid)]
-        if comment is not None: useradd_cmd += ["-c", comment]
-        if home is not None: useradd_cmd += ["-d", home]
-        if initial_group is not None: useradd_cmd += ["-g", initial_group]
-        if len(additional_groups) > 0:
-            useradd_cmd += ["-G", ",".join(additional_groups)]
-        if shell is not None: useradd_cmd += ["-s", shell]
-        if create_home: useradd_cmd += ["-m"]
-        if empty_password: useradd_cmd += ["-p", ""]
-        useradd_cmd.append(name)
-        logging.info("Creating user %s..." % name)
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [f"--overlay-image={variant.upper_image}:upper", variant.lower_image] + useradd_cmd, check=True)
+    account_commands = [groupadd_command(group) for group in groups] + [useradd_command(user) for user in users]
+
+    setup_commands = genpack_json.get("setup_commands", [])
+    if not isinstance(setup_commands, list):
+        raise ValueError("setup_commands must be a list")
+    for cmd in setup_commands:
+        if not isinstance(cmd, (str, dict)):
+            raise ValueError("setup_commands must be a list of strings or dicts")
+
+    services = merged_genpack_json.get("services", [])
+
+    # 1. execute package scripts and generate /.genpack/ metadata (must run before artifact scripts)
+    def run_package_scripts(container):
+        logging.info("Executing package scripts and generating metadata...")
+        container.run(["genpack-exec-package-scripts"], env=artifact_env)
+
+    # 2. + 3. create groups and users (validated up front, applied in one go)
+    def create_accounts(container):
+        logging.info(f"Creating {len(groups)} group(s) and {len(users)} user(s)...")
+        container.run("set -e\n" + "\n".join(shlex.join(cmd) for cmd in account_commands))
 
     # 4. copy contents from files directory to upper image + execute artifact build scripts
-    script = """set -e
+    def copy_files(container):
+        script = """set -e
 if [ -d /mnt/host/files ]; then
     echo "Copying files from /mnt/host/files to upper image..."
     cp -rdv /mnt/host/files/. /
 fi
 execute-artifact-build-scripts
 touch /usr""" # see https://www.freedesktop.org/software/systemd/man/systemd-update-done.service.html
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [
-                    *env_opts,
-                    "--console=pipe",
-                    f"--download-dir={download_dir}",
-                    f"--overlay-image={variant.upper_image}:upper", variant.lower_image,
-                    "sh"],
-                   input=script, text=True, check=True)
+        container.run(["sh"], env=artifact_env, input=script)
 
     # 5. setup_commands
-    if "setup_commands" in genpack_json:
-        setup_commands = genpack_json["setup_commands"]
-        if not isinstance(setup_commands, list):
-            raise ValueError("setup_commands must be a list")
+    def run_setup_commands(container):
         for cmd in setup_commands:
             if isinstance(cmd, str):
                 logging.info(f"Executing setup command: {cmd}")
-                subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [
-                                f"--overlay-image={variant.upper_image}:upper",
-                                f"--download-dir={download_dir}",
-                                *env_opts,
-                                variant.lower_image, "sh", "-c", cmd], check=True)
-            elif isinstance(cmd, dict):
-                pass # TBD: support more complex command with options
+                container.run(["sh", "-c", cmd], env=artifact_env)
             else:
-                raise ValueError("setup_commands must be a list of strings or dicts")
+                pass # TBD: support more complex command with options
 
     # 6. enable services
-    services = merged_genpack_json.get("services", [])
-    if len(services) > 0:
-        subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [f"--overlay-image={variant.upper_image}:upper", variant.lower_image, "systemctl", "enable"] + services, check=True)
+    def enable_services(container):
+        container.run(["systemctl", "enable"] + services)
 
     # 7. copy-up all runtime package files via overlayfs (must run last)
-    logging.info("Triggering overlayfs copy-up for runtime package files...")
-    subprocess.run(["genpack-helper", "nspawn"] + nspawn_opts + [
-                    f"--overlay-image={variant.upper_image}:upper",
-                    variant.lower_image, "genpack-copyup"],
-                    check=True)
+    def copyup(container):
+        logging.info("Triggering overlayfs copy-up for runtime package files...")
+        container.run(["genpack-copyup"])
+
+    # (name, inputs, function); inputs are what incremental builds fingerprint
+    # the capacity is an input of the first step: snapshots all share the size of the image they were taken of
+    steps = [("package-scripts", {"lower": os.stat(variant.lower_done).st_mtime_ns, "env": artifact_env,
+                                  "capacity": upper_size_in_gib}, run_package_scripts)]
+    if len(account_commands) > 0: steps.append(("accounts", account_commands, create_accounts))
+    steps.append(("files", {"files": tree_fingerprint("files"), "env": artifact_env}, copy_files))
+    if len(setup_commands) > 0: steps.append(("setup-commands", {"commands": setup_commands, "env": artifact_env}, run_setup_commands))
+    if len(services) > 0: steps.append(("services", services, enable_services))
+    steps.append(("copyup", None, copyup))
+
+    # download_dir is shared with other genpack processes; hold it shared so nothing cleans it meanwhile
+    with DirectoryLock(download_dir, mode="shared"):
+        if not incremental:
+            shutil.rmtree(variant.upper_snapshot_dir, ignore_errors=True)
+            # always recreate upper image fresh
+            with build_report.step("create upper image"):
+                create_image(variant.upper_image, upper_size_in_gib)
+            # all steps up to the copy-up run in one container (the upper image stays mounted)
+            with nspawn_container(variant.lower_image, nspawn_opts) as container:
+                for _, _, func in steps:
+                    func(container)
+        else:
+            # each step's fingerprint covers its own inputs and those of all steps before it,
+            # so the latest snapshot with a matching fingerprint is a valid starting point
+            fingerprints = []
+            fingerprint = ""
+            for name, inputs, _ in steps:
+                fingerprint = hashlib.sha256(json.dumps([fingerprint, name, inputs], sort_keys=True).encode()).hexdigest()
+                fingerprints.append(fingerprint)
+            start = 0
+            for i in reversed(range(len(steps))):
+                snapshot = os.path.join(variant.upper_snapshot_dir, f"{steps[i][0]}.img")
+                if os.path.isfile(snapshot) and os.path.isfile(snapshot + ".fingerprint") \
+                        and open(snapshot + ".fingerprint").read().strip() == fingerprints[i]:
+                    logging.info(f"Inputs unchanged up to step '{steps[i][0]}', reusing its upper image snapshot.")
+                    with build_report.step(f"restore snapshot {steps[i][0]}"):
+                        copy_image(snapshot, variant.upper_image)
+                    start = i + 1
+                    break
+            if start == 0:
+                with build_report.step("create upper image"):
+                    create_image(variant.upper_image, upper_size_in_gib)
+            os.makedirs(variant.upper_snapshot_dir, exist_ok=True)
+            # snapshots need the upper image unmounted, so every step gets its own container here
+            for i in range(start, len(steps)):
+                name, _, func = steps[i]
+                with nspawn_container(variant.lower_image, nspawn_opts) as container:
+                    func(container)
+                snapshot = os.path.join(variant.upper_snapshot_dir, f"{name}.img")
+                with build_report.step(f"save snapshot {name}"):
+                    copy_image(variant.upper_image, snapshot)
+                with open(snapshot + ".fingerprint", "w") as f:
+                    f.write(fingerprints[i] + "\n")
 
     # 8. copy /dev from lower into upper (device nodes cannot be copy-upped inside
     #    nspawn user namespace due to mknod restrictions; done on host side instead)
     logging.info("Copying /dev from lower image to upper image...")
-    subprocess.run(["genpack-helper", "copyup-dev", variant.lower_image, f"{variant.upper_image}:upper"], check=True)
+    with build_report.step("copy /dev", [variant.upper_image]):
+        subprocess.run(["genpack-helper", "copyup-dev", variant.lower_image, f"{variant.upper_image}:upper"], check=True)
 
 def upper_bash(variant):
     if not os.path.isfile(variant.upper_image):
@@ -1187,7 +2707,91 @@ def upper_bash(variant):
     logging.info("Running bash in the upper directory for debugging.")
     subprocess.run(["genpack-helper", "nspawn", f"--overlay-image={variant.upper_image}:upper", variant.lower_image, "bash"], check=True)
 
-def pack(variant, compression=None):
+def parse_block_size(value):
+    """SquashFS block size in bytes from a number of bytes or a string like "128K" or "1M"."""
+    m = re.fullmatch(r'(\d+)([KkMm]?)', str(value).strip())
+    size = int(m.group(1)) * {"": 1, "k": 1024, "m": 1024 * 1024}[m.group(2).lower()] if m else None
+    if size is None or size < 4096 or size > 1024 * 1024 or size & (size - 1) != 0:
+        raise ValueError(f"Invalid block size {value!r}: must be a power of two between 4K and 1M")
+    #else
+    return size
+
+def compression_settings(config, overrides={}):
+    """Compression of the final image from genpack.json's compression (a name or a dictionary of
+    algorithm, level, processors and block_size) with the non-None values of overrides applied.
+    Unset values are left to genpack-create-image."""
+    if isinstance(config, str): config = {"algorithm": config}
+    if not isinstance(config, dict) or any(k not in ("algorithm", "level", "processors", "block_size") for k in config):
+        raise ValueError("compression must be an algorithm name or a dictionary with 'algorithm' and optional 'level', 'processors' and 'block_size'")
+    #else
+    settings = {"algorithm": "gzip", "level": None, "processors": None, "block_size": None}
+    settings.update(config)
+    if overrides.get("algorithm") not in (None, settings["algorithm"]):
+        settings["level"] = None # a level configured for another algorithm does not apply
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    algorithm = settings["algorithm"]
+    if algorithm not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {algorithm!r}, must be one of {', '.join(COMPRESSIONS)}")
+    if settings["level"] is not None:
+        if algorithm not in COMPRESSION_LEVELS:
+            raise ValueError(f"Compression {algorithm} does not take a level")
+        low, high = COMPRESSION_LEVELS[algorithm]
+        if not isinstance(settings["level"], int) or not low <= settings["level"] <= high:
+            raise ValueError(f"Compression level of {algorithm} must be between {low} and {high}")
+    if settings["processors"] is not None and (not isinstance(settings["processors"], int) or settings["processors"] < 1):
+        raise ValueError("Number of processors for packing must be a positive integer")
+    if settings["block_size"] is not None:
+        settings["block_size"] = parse_block_size(settings["block_size"])
+    return settings
+
+def compression_label(settings):
+    label = settings["algorithm"]
+    if settings["level"] is not None: label += f" level {settings['level']}"
+    if settings["block_size"] is not None: label += f", {settings['block_size'] // 1024}K blocks"
+    if settings["processors"] is not None: label += f", {settings['processors']} processors"
+    return label
+
+def create_image_options(settings):
+    """genpack-create-image options for the compression settings; unset ones are not passed at all so
+    that a genpack-create-image without them keeps working with the defaults."""
+    options = ["--compression", settings["algorithm"]]
+    if settings["level"] is not None: options += ["--compression-level", str(settings["level"])]
+    if settings["block_size"] is not None: options += ["--block-size", str(settings["block_size"])]
+    if settings["processors"] is not None: options += ["--processors", str(settings["processors"])]
+    return options
+
+def check_create_image_options(lower_image, settings):
+    """Fail unless the genpack-create-image of the lower image knows all options the compression
+    settings need. genpack-progs releases before these options reject them only after upper is built."""
+    options = [option for option in create_image_options(settings)[2:] if option.startswith("--")]
+    if len(options) == 0: return
+    #else
+    usage = subprocess.run(["genpack-helper", "nspawn", "--console=pipe", lower_image, "sh", "-c", "genpack-create-image --help 2>&1"],
+                           stdout=subprocess.PIPE, text=True, errors="replace").stdout
+    missing = [option for option in options if re.search(re.escape(option) + r'\b', usage) is None]
+    if len(missing) > 0:
+        raise ValueError(f"genpack-create-image in {lower_image} does not support {', '.join(missing)}; update genpack-progs "
+                         "or drop the compression level, block size and processors settings")
+
+def log_pack_history(path):
+    """Log the latest pack of each compression setting recorded in the pack history, smallest image first."""
+    latest = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            latest[compression_label(record["compression"])] = record
+    logging.info(f"{'Compression':<48} {'Size':>10} {'Wall':>8} {'CPU':>8} {'Speed':>11}")
+    for label, record in sorted(latest.items(), key=lambda x: x[1]["size"]):
+        logging.info(f"{label[:48]:<48} {record['size'] / 1024 / 1024:>7.1f}MiB {record['wall']:>7.1f}s "
+                     f"{record['cpu']:>7.1f}s {record['input_size'] / 1024 / 1024 / max(record['wall'], 0.001):>6.1f}MiB/s")
+
+def pack(variant, compression={}):
+    """Create the final image from the upper image. compression overrides genpack.json's compression
+    settings (see compression_settings()); the image size and pack time are recorded in the build
+    report and appended to the pack history of the variant."""
     if not os.path.isfile(variant.lower_image):
         raise FileNotFoundError(f"Lower image {variant.lower_image} does not exist. Please run 'lower' first.")
     if not os.path.isfile(variant.lower_done):
@@ -1204,36 +2808,31 @@ def pack(variant, compression=None):
         name += f"-{variant.name}"
     outfile = merged_genpack_json.get("outfile", f"{name}-{arch}.squashfs")
 
-    if compression is None:
-        compression = genpack_json.get("compression", "gzip")
+    settings = compression_settings(genpack_json.get("compression", "gzip"), compression)
+    check_create_image_options(variant.lower_image, settings)
 
     if os.path.exists(outfile):
         logging.info(f"Output file {outfile} already exists, removing it.")
         os.remove(outfile)
 
     imageprefix = f"/mnt/host/{outfile.removesuffix('.squashfs')}"
-    subprocess.run(
-        ["genpack-helper", "nspawn", "--console=pipe", f"--extra-image={variant.upper_image}",
-         variant.lower_image, "genpack-create-image", "/mnt/extra/upper", imageprefix,
-         "--compression", compression],
-        check=True
-    )
-
-def get_latest_mtime(*args):
-    latest = 0.0
-    for arg in args:
-        if isinstance(arg, float): latest = max(latest, arg)
-        elif isinstance(arg, str):
-            if os.path.isfile(arg):
-                latest = max(latest, os.path.getmtime(arg))
-            elif os.path.isdir(arg):
-                latest = max(latest, os.path.getmtime(arg), get_latest_mtime(*(os.path.join(arg, f) for f in os.listdir(arg) if os.path.exists(os.path.join(arg, f)))))
-
-        elif isinstance(arg, list):
-            latest = max(latest, get_latest_mtime(*arg))
-
-    logging.debug(f"Latest mtime from {args} is {latest}")
-    return latest
+    input_size = BuildReport._allocated(variant.upper_image)
+    with build_report.step(f"create {outfile} ({compression_label(settings)})", [outfile]) as entry:
+        subprocess.run(
+            ["genpack-helper", "nspawn", "--console=pipe", f"--extra-image={variant.upper_image}",
+             variant.lower_image, "genpack-create-image", "/mnt/extra/upper", imageprefix]
+            + create_image_options(settings),
+            check=True
+        )
+        entry["compression"] = settings
+        entry["output_size"] = os.path.getsize(outfile)
+
+    record = {"time": time.time(), "compression": settings, "size": entry["output_size"], "input_size": input_size,
+              "wall": entry["wall"], "cpu": entry["cpu_user"] + entry["cpu_system"]}
+    logging.info(f"Packed {outfile}: {record['size'] / 1024 / 1024:.1f} MiB in {record['wall']:.1f}s with {compression_label(settings)}.")
+    with open(variant.pack_history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    log_pack_history(variant.pack_history)
 
 def create_archive():
     logging.info("Creating archive of the current directory...")
@@ -1259,32 +2858,131 @@ def create_archive():
     logging.info(f"Archive created: {archive_name}")
     return archive_name
 
+def matrix_child_argv(args, target_arch, variant_name):
+    """Command line running one variant/arch pair of a build matrix in its own genpack process."""
+    argv = [sys.executable, os.path.abspath(sys.argv[0]), "--arch", target_arch]
+    if variant_name is not None: argv += ["--variant", variant_name]
+    for flag in ["debug", "independent_binpkgs", "independent_distfiles", "deep_depclean", "break_circular_deps", "parallel",
+                 "offline", "no_build_session", "incremental", "devel"]:
+        if getattr(args, flag): argv.append("--" + flag.replace("_", "-"))
+    if args.overlay_override is not None: argv += ["--overlay-override", args.overlay_override]
+    if args.mirror is not None: argv += ["--mirror", args.mirror]
+    if args.overlay_url is not None: argv += ["--overlay-url", args.overlay_url]
+    if args.binhost is not None: argv += ["--binhost", args.binhost]
+    if args.binhost_push: argv.append("--binhost-push")
+    if args.compression is not None: argv += ["--compression", args.compression]
+    if args.compression_level is not None: argv += ["--compression-level", str(args.compression_level)]
+    if args.pack_processors is not None: argv += ["--pack-processors", str(args.pack_processors)]
+    if args.block_size is not None: argv += ["--block-size", args.block_size]
+    if args.portage_tmpfs is not None: argv += ["--portage-tmpfs", args.portage_tmpfs]
+    if args.ccache: argv.append("--ccache")
+    if args.ccache_size is not None: argv += ["--ccache-size", args.ccache_size]
+    return argv + [args.action]
+
+def build_matrix(args, arches, variant_names, jobs):
+    """Build every variant/arch pair, up to 'jobs' of them at a time.
+
+    Each pair runs as a separate genpack process (the per-arch state lives in module globals) with its
+    output in work/{arch}/{action}[-{variant}].log. Tarballs are fetched under a lock, the tarball cache
+    and image templates are locked already, and portage serializes writers of binpkgs and distfiles.
+    Returns True if all pairs succeeded.
+    """
+    pairs = [(a, v) for a in arches for v in variant_names]
+    logging.info(f"Building {len(pairs)} variant/arch pair(s) with up to {jobs} at a time.")
+
+    def run(target_arch, variant_name):
+        label = target_arch if variant_name is None else f"{variant_name}/{target_arch}"
+        log_dir = os.path.join(work_root, target_arch)
+        os.makedirs(log_dir, exist_ok=True)
+        log_file = os.path.join(log_dir, args.action + ("" if variant_name is None else f"-{variant_name}") + ".log")
+        logging.info(f"[{label}] started, logging to {log_file}")
+        start = time.monotonic()
+        with open(log_file, "w") as f:
+            returncode = subprocess.run(matrix_child_argv(args, target_arch, variant_name),
+                                        stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT).returncode
+        elapsed = time.monotonic() - start
+        if returncode == 0:
+            logging.info(f"[{label}] succeeded in {elapsed:.0f}s")
+        else:
+            logging.error(f"[{label}] failed with exit code {returncode} after {elapsed:.0f}s, see {log_file}")
+        return label, returncode, elapsed, log_file
+
+    create_work_root()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda pair: run(*pair), pairs))
+
+    logging.info("Build matrix summary:")
+    for label, returncode, elapsed, log_file in results:
+        status = "ok" if returncode == 0 else f"FAILED ({returncode})"
+        logging.info(f"  {label:<32} {status:<12} {elapsed:>7.0f}s  {log_file}")
+    return all(returncode == 0 for _, returncode, _, _ in results)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Genpack image Builder")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
-    parser.add_argument("--arch", choices=sorted(ELF_MACHINE.keys()), default=None, help="Target architecture for cross building (default: host architecture)")
+    parser.add_argument("--arch", default=None, help="Target architecture for cross building (default: host architecture); a comma separated list builds each of them")
     parser.add_argument("--overlay-override", default=None, help="Directory to override genpack-overlay")
     parser.add_argument("--independent-binpkgs", action="store_true", help="Use independent binpkgs, do not use shared one")
+    parser.add_argument("--independent-distfiles", action="store_true", help="Keep distfiles inside the lower image instead of the shared distfiles cache")
     parser.add_argument("--deep-depclean", action="store_true", help="Perform deep depclean, removing all non-runtime packages"  )
     parser.add_argument("--break-circular-deps", action="store_true", help="Force the circular dependency breaker even on an already-built lower image (normally it runs only on a freshly extracted one)")
-    parser.add_argument("--parallel", action="store_true", help="Build multiple packages in parallel (--jobs and --load-average set to CPU count)")
-    parser.add_argument("--compression", choices=["gzip", "xz", "lzo", "none"], default=None, help="Compression type for the final SquashFS image")
+    parser.add_argument("--parallel", action="store_true", help="Build in parallel with emerge jobs, MAKEOPTS and load limit planned from CPU count and available memory")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default=None, help="Compression type for the final SquashFS image")
+    parser.add_argument("--compression-level", type=int, default=None, metavar="N", help="Compression level for gzip, lzo (1-9) or zstd (1-22)")
+    parser.add_argument("--pack-processors", type=int, default=None, metavar="N", help="Number of processors mksquashfs compresses with (default: all)")
+    parser.add_argument("--block-size", default=None, metavar="SIZE", help="SquashFS block size, a power of two from 4K to 1M (e.g. 256K)")
+    parser.add_argument("--offline", action="store_true", help="Do not access the network in lower; use the tarballs already downloaded as is")
+    parser.add_argument("--mirror", default=None, metavar="URL", help="Gentoo mirror to fetch stage3 and portage tarballs (and distfiles) from, e.g. one served by 'genpack mirror serve'")
+    parser.add_argument("--overlay-url", default=None, metavar="URL", help="URL of the genpack-overlay tarball")
+    parser.add_argument("--binhost", default=None, help="Pull binary packages from (and with --binhost-push, push them to) this http(s):// or file:// binhost")
+    parser.add_argument("--binhost-push", action="store_true", help="Upload the binary packages built by lower to the binhost")
+    parser.add_argument("--ccache", action="store_true", help="Compile lower packages through ccache with a persistent per-arch cache")
+    parser.add_argument("--ccache-size", default=None, metavar="SIZE", help=f"Size limit of the ccache cache (default: {DEFAULT_CCACHE_SIZE})")
+    parser.add_argument("--portage-tmpfs", default=None, metavar="SIZE", help="Build lower packages in a tmpfs of SIZE (e.g. 16G) mounted at /var/tmp/portage")
+    parser.add_argument("--no-build-session", action="store_true", help="Start a new container for every command instead of one per build phase")
+    parser.add_argument("--incremental", action="store_true", help="Reuse upper image snapshots of steps whose inputs are unchanged instead of rebuilding upper from scratch")
     parser.add_argument("--devel", action="store_true", help="Generate development image, if supported by genpack.json")
     parser.add_argument("--variant", default=None, help="Variant to use from genpack.json, if supported")
-    parser.add_argument("action", choices=["build", "lower", "bash", "upper", "upper-bash", "upper-clean", "pack", "archive"], nargs="?", default="build", help="Action to perform")
-    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run in the lower image when action is 'bash'")
+    parser.add_argument("--all-variants", action="store_true", help="Build every variant defined in genpack.json")
+    parser.add_argument("--jobs", "-j", type=int, default=2, help="Number of variant/arch pairs built concurrently with --all-variants or multiple --arch (default: 2)")
+    parser.add_argument("action", choices=["build", "lower", "bash", "upper", "upper-bash", "upper-clean", "pack", "archive", "cache", "gc", "mirror"], nargs="?", default="build", help="Action to perform")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run in the lower image when action is 'bash', or arguments of 'cache', 'gc' and 'mirror'")
     args = parser.parse_args()
     debug = args.debug
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
-    if args.arch is not None and args.arch != arch:
-        arch = args.arch
+    arches = [arch] if args.arch is None else args.arch.split(",")
+    for a in arches:
+        if a not in ELF_MACHINE:
+            parser.error(f"unsupported architecture '{a}' (choose from {', '.join(sorted(ELF_MACHINE.keys()))})")
+    matrix = len(arches) > 1 or args.all_variants
+    if matrix and args.action not in ["build", "lower", "upper", "pack"]:
+        parser.error(f"--all-variants and multiple architectures are not supported with '{args.action}'")
+    if matrix and args.variant is not None:
+        parser.error("--variant cannot be combined with --all-variants or multiple architectures")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if not matrix and arches[0] != arch:
+        arch = arches[0]
         work_dir = os.path.join(work_root, arch)
         cache_arch_dir = os.path.join(cache_root, arch)
         binpkgs_dir = os.path.join(cache_arch_dir, "binpkgs")
+        ccache_dir = os.path.join(cache_arch_dir, "ccache")
         logging.info(f"Cross building for {arch} on {host_arch}.")
 
-    genpack_json, genpack_json_time = load_genpack_json()
+    if args.action == "cache":
+        # the tarball cache is shared across artifacts, no genpack.json needed
+        cache_command(args.command)
+        exit(0)
+    if args.action == "gc":
+        gc_command(args.command)
+        exit(0)
+    if args.action == "mirror":
+        mirror_command(args.command)
+        exit(0)
+
+    genpack_json, _ = load_genpack_json()
     if "name" not in genpack_json:
         genpack_json["name"] = os.path.basename(os.getcwd())
         logging.warning(f"'name' not found in genpack.json. using default: {genpack_json['name']}")  
@@ -1315,12 +3013,44 @@ if __name__ == "__main__":
         create_archive()
         exit(0)
 
+    if matrix:
+        variant_names = list(genpack_json.get("variants", {}).keys()) if args.all_variants else []
+        if len(variant_names) == 0:
+            variant_names = [args.variant or genpack_json.get("default_variant", None)]
+        exit(0 if build_matrix(args, arches, variant_names, args.jobs) else 1)
+
     overlay_override = args.overlay_override
 
     independent_binpkgs = args.independent_binpkgs or genpack_json.get("independent_binpkgs", False)
+    independent_distfiles = args.independent_distfiles or genpack_json.get("independent_distfiles", False)
     deep_depclean = args.deep_depclean
     break_circular_deps = args.break_circular_deps
-    parallel = args.parallel
+    parallel = args.parallel or genpack_json.get("parallel", False) not in (False, None)
+    offline = args.offline
+    build_session = not args.no_build_session
+    ccache_config = genpack_json.get("ccache", False)
+    if isinstance(ccache_config, dict): ccache_config = ccache_config.get("size", True)
+    if args.ccache and ccache_config in (False, None): ccache_config = True
+    ccache_size = None if ccache_config in (False, None) else args.ccache_size or (DEFAULT_CCACHE_SIZE if ccache_config is True else str(ccache_config))
+    tmpfs_config = genpack_json.get("portage_tmpfs", None)
+    if isinstance(tmpfs_config, dict): tmpfs_config = tmpfs_config.get("size", None)
+    portage_tmpfs = args.portage_tmpfs or tmpfs_config
+    binhost_config = genpack_json.get("binhost", None)
+    if isinstance(binhost_config, str): binhost_config = {"url": binhost_config}
+    if binhost_config is not None and (not isinstance(binhost_config, dict) or "url" not in binhost_config):
+        raise ValueError("binhost must be a URL or a dictionary with 'url' and optional 'push'")
+    binhost = args.binhost or (binhost_config["url"] if binhost_config else None)
+    binhost_push = args.binhost_push or (binhost_config or {}).get("push", False)
+    mirror_config = genpack_json.get("mirror", {})
+    if isinstance(mirror_config, str): mirror_config = {"gentoo": mirror_config}
+    if not isinstance(mirror_config, dict) or any(k not in ("gentoo", "overlay") for k in mirror_config):
+        raise ValueError("mirror must be a URL or a dictionary with optional 'gentoo' and 'overlay' URLs")
+    gentoo_mirror = args.mirror or mirror_config.get("gentoo", None)
+    if gentoo_mirror is not None:
+        base_url = gentoo_mirror.rstrip("/") + "/"
+        gentoo_mirrors = base_url.rstrip("/")
+        logging.info(f"Using Gentoo mirror {base_url}")
+    overlay_url = args.overlay_url or mirror_config.get("overlay", DEFAULT_OVERLAY_URL)
 
     variant = Variant(args.variant or genpack_json.get("default_variant", None))
     if variant.name is not None:
@@ -1347,30 +3077,29 @@ if __name__ == "__main__":
         raise ValueError("upper-clean is not implemented yet, use 'upper' and then remove upper directory manually.")
     #else
 
-    def is_lower_outdated():
-        if not os.path.exists(variant.lower_done): return False
-        #else
-        lower_done_mtime = os.path.getmtime(variant.lower_done)
-        latest_mtime = get_latest_mtime(genpack_json_time, "savedconfig", "patches", "kernel", "env", "overlay")
-        if lower_done_mtime < latest_mtime:
-            logging.info(f"Lower completion marker {variant.lower_done} is outdated, rebuilding lower layer.")
-            return True
-        world_mtime = subprocess.run(["genpack-helper", "nspawn", "--console=pipe", variant.lower_image, "stat", "-c", "%Y", "/var/lib/portage/world"], capture_output=True, text=True)
-        if world_mtime.returncode != 0:
-            logging.error("Failed to get world file mtime. rebuilding lower layer.")
-            return True
-        #else
-        if lower_done_mtime < int(world_mtime.stdout.strip()):
-            logging.info(f"Lower completion marker {variant.lower_done} is older than world file, rebuilding lower layer.")
-            return True
-        #else
-        return False
-
-    if args.action in ["build", "lower"]:
-        if is_lower_outdated() or (args.action == "lower" and os.path.exists(variant.lower_done)):
-            os.remove(variant.lower_done)
-        lower(variant, args.devel)
-    if args.action in ["build", "upper"]:
-        upper(variant)
-    if args.action in ["build", "pack"]:
-        pack(variant, args.compression)
+    pack_compression = {"algorithm": args.compression, "level": args.compression_level,
+                        "processors": args.pack_processors, "block_size": args.block_size}
+    if args.action == "build":
+        # don't find out about unusable compression settings only after lower and upper are built
+        pack_settings = compression_settings(genpack_json.get("compression", "gzip"), pack_compression)
+        if os.path.isfile(variant.lower_done):
+            check_create_image_options(variant.lower_image, pack_settings)
+
+    try:
+        if args.action in ["build", "lower"]:
+            # an explicit 'lower' always runs the whole pipeline; 'build' only redoes what changed
+            if args.action == "lower" and os.path.exists(variant.lower_done):
+                os.remove(variant.lower_done)
+            with build_report.phase("lower", [variant.lower_image]):
+                lower(variant, args.devel)
+        if args.action in ["build", "upper"]:
+            with build_report.phase("upper", [variant.upper_image]):
+                upper(variant, args.incremental)
+        if args.action in ["build", "pack"]:
+            with build_report.phase("pack"):
+                pack(variant, pack_compression)
+    finally:
+        os.makedirs(work_dir, exist_ok=True)
+        build_report.write(variant.build_report, action=args.action, arch=arch, variant=variant.name, artifact=genpack_json["name"])
+        build_report.log_summary()
+        logging.info(f"Build report written to {variant.build_report}")